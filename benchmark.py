@@ -0,0 +1,535 @@
+"""
+Benchmark harness for the FileWay backend; needs no network.
+
+Generates synthetic corpora (text-only, scanned and mixed PDFs of 1/50/500 pages, a batch of
+one-page invoices sharing a logo, plus one image per format /changeImgExt accepts), serves them from a local HTTP fixture server and
+drives every endpoint in-process through the ASGI app, first one request at a time and then
+under concurrent load. Reports p50/p95/p99 latency, throughput, peak RSS (this process plus
+its worker processes) and output size, and writes everything to JSON so runs can be
+compared across commits:
+
+    python benchmark.py --sizes 1,50 --output before.json
+    python benchmark.py --sizes 1,50 --output after.json --compare before.json
+    python benchmark.py --only 'compress|dark' --sizes 500 --iterations 3
+
+The result cache is always disabled, the download cache unless --download-cache is given and
+the in-process document / rendered page / extracted text caches unless --page-caches is, so
+repeated iterations measure the work rather than cache hits.
+"""
+
+import argparse
+import asyncio
+import functools
+import http.server
+import io
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw
+
+CORPUS_VERSION = "1"
+PDF_KINDS = ("text", "scanned", "mixed")
+DEFAULT_SIZES = "1,50,500"
+PASSWORD = "bench"
+INVOICES = 20
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut "
+    "labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco "
+    "laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in "
+    "voluptate velit esse cillum dolore eu fugiat nulla pariatur. "
+)
+
+
+###==================================================================###
+# Corpus: deterministic (seeded) so every run and every commit measures the same inputs.
+# Files are cached in --corpus-dir and only generated when missing.
+
+def _scan_image(rng: random.Random, page_num: int) -> bytes:
+    """A greyscale 150 dpi A4 'scan': paper noise plus dark bars standing in for text lines."""
+    width, height = 1240, 1754
+    img = Image.new("L", (width, height), 238)
+    draw = ImageDraw.Draw(img)
+    for _ in range(400):  # paper speckle
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.point((x, y), fill=rng.randrange(180, 230))
+    y = 120 + rng.randrange(20)
+    while y < height - 120:
+        x = 100
+        while x < width - 120:
+            word = rng.randrange(20, 90)
+            draw.rectangle((x, y, min(x + word, width - 100), y + 14), fill=rng.randrange(20, 70))
+            x += word + rng.randrange(10, 18)
+        y += 30 + rng.randrange(4)
+    draw.text((width // 2, height - 80), str(page_num + 1), fill=0)
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=70)
+    return out.getvalue()
+
+
+def _add_text_page(doc: fitz.Document, rng: random.Random, page_num: int) -> None:
+    page = doc.new_page(width=595, height=842)
+    words = LOREM.split()
+    text = " ".join(rng.choice(words) for _ in range(450))
+    page.insert_textbox(fitz.Rect(50, 60, 545, 790), f"Page {page_num + 1}\n\n{text}", fontsize=10)
+    page.draw_rect(fitz.Rect(50, 800, 545, 805), color=(0.2, 0.3, 0.6), fill=(0.2, 0.3, 0.6))
+
+
+def _add_scanned_page(doc: fitz.Document, rng: random.Random, page_num: int) -> None:
+    page = doc.new_page(width=595, height=842)
+    page.insert_image(page.rect, stream=_scan_image(rng, page_num))
+
+
+def make_pdf(kind: str, pages: int) -> bytes:
+    rng = random.Random(f"{kind}-{pages}")
+    doc = fitz.open()
+    for page_num in range(pages):
+        scanned = kind == "scanned" or (kind == "mixed" and page_num % 2 == 1)
+        if scanned:
+            _add_scanned_page(doc, rng, page_num)
+        else:
+            _add_text_page(doc, rng, page_num)
+    try:
+        return doc.tobytes(garbage=3, deflate=True)
+    finally:
+        doc.close()
+
+
+def _logo_image() -> bytes:
+    """A noisy 320x120 PNG that barely compresses, so storing it once vs per page shows."""
+    rng = random.Random("logo")
+    img = Image.frombytes("RGB", (320, 120), bytes(rng.randrange(256) for _ in range(320 * 120 * 3)))
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+def make_invoice(number: int, logo: bytes) -> bytes:
+    """A one-page invoice with the shared logo, like a batch a user would merge into one file."""
+    rng = random.Random(f"invoice-{number}")
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_image(fitz.Rect(50, 40, 290, 130), stream=logo)
+    lines = [f"Invoice #{number + 1}", ""]
+    lines += [f"{rng.choice(LOREM.split()):<20} {rng.randrange(1, 10):>3} x {rng.randrange(100, 9999) / 100:>8.2f}" for _ in range(12)]
+    page.insert_textbox(fitz.Rect(50, 160, 545, 790), "\n".join(lines), fontsize=11, fontname="cour")
+    try:
+        return doc.tobytes(garbage=3, deflate=True)
+    finally:
+        doc.close()
+
+
+def make_image(fmt: str) -> bytes:
+    """A 1200x800 photo-like test card in `fmt` (a PIL format name)."""
+    rng = random.Random(f"image-{fmt}")
+    img = Image.new("RGB", (1200, 800))
+    draw = ImageDraw.Draw(img)
+    for y in range(800):
+        draw.line((0, y, 1200, y), fill=(y * 255 // 800, 120, 255 - y * 255 // 800))
+    for _ in range(60):
+        x, y, r = rng.randrange(1200), rng.randrange(800), rng.randrange(10, 80)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    if fmt in ("GIF", "PPM", "BMP", "ICO", "EPS"):
+        img = img.convert("RGB")
+    if fmt == "ICO":
+        img = img.resize((256, 256))
+    out = io.BytesIO()
+    img.save(out, format=fmt)
+    return out.getvalue()
+
+
+def build_corpus(corpus_dir: str, sizes: list[int], image_formats: dict) -> dict:
+    """Writes the corpus (if missing) and returns {name: {"file" or "files", "bytes", "pages"?}}."""
+    root = os.path.join(corpus_dir, f"v{CORPUS_VERSION}")
+    os.makedirs(root, exist_ok=True)
+    corpus = {}
+
+    def ensure(name: str, generate) -> str:
+        path = os.path.join(root, name)
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            data = generate()
+            with open(path + ".part", "wb") as f:
+                f.write(data)
+            os.replace(path + ".part", path)
+            print(f"  generated {name} ({len(data) / 1024:.0f} KB, {time.perf_counter() - started:.1f}s)")
+        return name
+
+    for kind in PDF_KINDS:
+        for pages in sizes:
+            name = ensure(f"{kind}-{pages}.pdf", functools.partial(make_pdf, kind, pages))
+            corpus[f"{kind}-{pages}"] = {"file": name, "pages": pages, "kind": kind}
+
+    def locked_copy(source: str) -> bytes:
+        with fitz.open(os.path.join(root, source)) as doc:
+            return doc.tobytes(encryption=fitz.PDF_ENCRYPT_AES_256, user_pw=PASSWORD, owner_pw=PASSWORD)
+
+    for pages in sizes:
+        name = ensure(f"locked-{pages}.pdf", functools.partial(locked_copy, f"text-{pages}.pdf"))
+        corpus[f"locked-{pages}"] = {"file": name, "pages": pages, "kind": "locked"}
+
+    logo = _logo_image()
+    invoices = [ensure(f"invoice-{i:02d}.pdf", functools.partial(make_invoice, i, logo)) for i in range(INVOICES)]
+    corpus[f"invoices-{INVOICES}"] = {"files": invoices, "pages": INVOICES, "kind": "invoices"}
+
+    for fmt, info in image_formats.items():
+        if info["mime"] == "application/pdf":
+            continue  # an output format only; PIL can't read PDFs back in
+        name = f"image.{info['ext']}"
+        if any(entry.get("file") == name for entry in corpus.values()):
+            continue  # JPG / JPEG and TIF / TIFF share a file
+        try:
+            ensure(name, functools.partial(make_image, "JPEG" if fmt == "JPG" else fmt))
+        except Exception as e:
+            print(f"  skipped {name}: {e}")
+            continue
+        corpus[f"image-{info['ext']}"] = {"file": name, "kind": "image"}
+
+    for entry in corpus.values():
+        entry["bytes"] = sum(os.path.getsize(os.path.join(root, f)) for f in entry.get("files", [entry.get("file")]))
+    return {"root": root, "files": corpus}
+
+
+###==================================================================###
+# Fixture server: serves the corpus over plain HTTP on localhost, like the file hosts the
+# JSON endpoints normally download from.
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_fixture_server(root: str) -> tuple[http.server.ThreadingHTTPServer, str]:
+    handler = functools.partial(_QuietHandler, directory=root)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+###==================================================================###
+# Scenarios: (name, path, corpus entry, JSON body). Bodies are built from the corpus entry
+# so e.g. split ranges and compression targets scale with the document.
+
+def _pdf_scenarios(base: str, name: str, entry: dict) -> list[tuple[str, str, dict]]:
+    url = f"{base}/{entry['file']}"
+    pages = entry["pages"]
+    size_kb = entry["bytes"] / 1024
+    if entry["kind"] == "locked":
+        # AES-256, which PyPDF2 can't decrypt without pycryptodome, so there's no pypdf2 variant
+        return [("unlock-pdf:pymupdf", "/unlock-pdf", {"pdf_urls": [url], "password": PASSWORD, "engine": "pymupdf"})]
+    return [
+        ("merge-pdfs:pymupdf", "/merge-pdfs", {"pdf_urls": [url, url], "engine": "pymupdf"}),
+        ("merge-pdfs:pypdf2", "/merge-pdfs", {"pdf_urls": [url, url], "engine": "pypdf2"}),
+        ("split-pdf", "/split-pdf", {"pdf_urls": [url], "start": 1, "end": min(pages, 10)}),
+        ("dark-mode-pdf:raster", "/dark-mode-pdf", {"pdf_urls": [url], "mode": "raster"}),
+        ("dark-mode-pdf:vector", "/dark-mode-pdf", {"pdf_urls": [url], "mode": "vector"}),
+        ("compress-pdf:raster", "/compress-pdf", {"pdf_urls": [url], "target_kb": max(50, size_kb / 2)}),
+        ("compress-pdf:structural", "/compress-pdf", {"pdf_urls": [url], "mode": "structural", "target_kb": size_kb}),
+        ("encrypt-pdf:pymupdf", "/encrypt-pdf", {"pdf_urls": [url], "password": PASSWORD, "engine": "pymupdf"}),
+        ("encrypt-pdf:pypdf2", "/encrypt-pdf", {"pdf_urls": [url], "password": PASSWORD, "engine": "pypdf2"}),
+        ("pdf-to-images", "/pdf-to-images", {"pdf_urls": [url]}),
+        ("pdf-to-word", "/pdf-to-word", {"pdf_urls": [url]}),
+        ("pdf-to-excel", "/pdf-to-excel", {"pdf_urls": [url]}),
+        ("pdf-to-powerpoint", "/pdf-to-powerpoint", {"pdf_urls": [url]}),
+        ("pdf-to-text", "/pdf-to-text", {"pdf_urls": [url]}),
+        ("pdf-to-ndjson", "/pdf-to-ndjson", {"pdf_urls": [url]}),
+        ("pdf-pipeline", "/pdf-pipeline", {"pdf_urls": [url], "steps": [
+            {"op": "split", "start": 1, "end": min(pages, 10)},
+            {"op": "compress", "mode": "structural", "target_kb": size_kb},
+            {"op": "encrypt", "password": PASSWORD},
+        ]}),
+    ]
+
+
+def _invoice_scenarios(base: str, name: str, entry: dict) -> list[tuple[str, str, dict]]:
+    urls = [f"{base}/{file}" for file in entry["files"]]
+    return [(f"merge-pdfs:{engine}", "/merge-pdfs", {"pdf_urls": urls, "engine": engine}) for engine in ("pymupdf", "pypdf2")]
+
+
+def _image_scenarios(base: str, name: str, entry: dict) -> list[tuple[str, str, dict]]:
+    url = f"{base}/{entry['file']}"
+    return [
+        ("changeImgExt:webp", "/changeImgExt", {"img_urls": [url], "UserDesiredConvertedExtension": "webp"}),
+        ("changeImgExt:png", "/changeImgExt", {"img_urls": [url], "UserDesiredConvertedExtension": "png"}),
+        ("resizeImgByKB", "/resizeImgByKB", {"img_urls": [url], "sizeInKB": 50}),
+        ("resizeImgByHW", "/resizeImgByHW", {"img_urls": [url], "width": 640, "height": 480}),
+    ]
+
+
+def build_scenarios(base: str, corpus: dict, only: str | None) -> list[dict]:
+    scenarios = []
+    for name, entry in corpus["files"].items():
+        make = {"image": _image_scenarios, "invoices": _invoice_scenarios}.get(entry["kind"], _pdf_scenarios)
+        for endpoint, path, body in make(base, name, entry):
+            scenario = f"{endpoint}@{name}"
+            if only and not re.search(only, scenario):
+                continue
+            scenarios.append({"scenario": scenario, "endpoint": endpoint, "corpus": name, "path": path, "body": body})
+    return scenarios
+
+
+###==================================================================###
+# Measurement
+
+def _rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _child_pids(pid: int) -> list[int]:
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return children
+
+
+def _tree_rss() -> int:
+    """RSS of this process plus its worker processes (0 where /proc isn't available)."""
+    pid = os.getpid()
+    return _rss_bytes(pid) + sum(_rss_bytes(child) for child in _child_pids(pid))
+
+
+class RssSampler:
+    """Samples the process tree's RSS in the background; `peak` is the highest seen."""
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _tree_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = _tree_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        if self.peak == 0:  # no /proc: fall back to this process's lifetime peak
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _percentile(ordered: list[float], q: float) -> float | None:
+    if not ordered:
+        return None
+    k = (len(ordered) - 1) * q
+    lo = math.floor(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _summary(latencies: list[float], sizes: list[int], errors: list[str], elapsed: float, peak_rss: int) -> dict:
+    ordered = sorted(latencies)
+    ms = lambda value: None if value is None else round(value * 1000, 2)  # noqa: E731
+    return {
+        "requests": len(latencies) + len(errors),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:3],
+        "latency_ms": {
+            "p50": ms(_percentile(ordered, 0.50)),
+            "p95": ms(_percentile(ordered, 0.95)),
+            "p99": ms(_percentile(ordered, 0.99)),
+            "mean": ms(sum(ordered) / len(ordered)) if ordered else None,
+            "min": ms(ordered[0]) if ordered else None,
+            "max": ms(ordered[-1]) if ordered else None,
+        },
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed > 0 else None,
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1),
+        "output_bytes": round(sum(sizes) / len(sizes)) if sizes else None,
+    }
+
+
+async def _request(client, scenario: dict) -> tuple[float, int | None, str | None]:
+    started = time.perf_counter()
+    try:
+        response = await client.post(scenario["path"], json=scenario["body"])
+        body = response.content
+    except Exception as e:
+        return time.perf_counter() - started, None, f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+        return elapsed, None, f"{response.status_code}: {body[:120].decode(errors='replace')}"
+    return elapsed, len(body), None
+
+
+async def run_sequential(client, scenario: dict, iterations: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        await _request(client, scenario)
+    latencies, sizes, errors = [], [], []
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            elapsed, size, error = await _request(client, scenario)
+            if error is None:
+                latencies.append(elapsed)
+                sizes.append(size)
+            else:
+                errors.append(error)
+        wall = time.perf_counter() - started
+    return {"mode": "sequential", "concurrency": 1, **_summary(latencies, sizes, errors, wall, rss.peak)}
+
+
+async def run_concurrent(client, scenario: dict, concurrency: int, requests: int) -> dict:
+    latencies, sizes, errors = [], [], []
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            elapsed, size, error = await _request(client, scenario)
+            if error is None:
+                latencies.append(elapsed)
+                sizes.append(size)
+            else:
+                errors.append(error)
+
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+    return {"mode": "concurrent", "concurrency": concurrency, **_summary(latencies, sizes, errors, wall, rss.peak)}
+
+
+###==================================================================###
+# Driver
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _configure_app_env(args) -> None:
+    """Must run before main is imported: its configuration is read at import time."""
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # measure a warmed-up worker, as a readiness-gated deployment would serve
+    os.environ.setdefault("WARMUP", "blocking")
+    # 500 A4 pages are ~1.4 GB of pixels at the compress dpi, past the default raster cap
+    os.environ.setdefault("COMPRESS_MAX_RASTER_BYTES", str(4 * 1024 * 1024 * 1024))
+    os.environ["RESULT_CACHE_MEMORY_BYTES"] = "0"
+    if not args.download_cache:
+        os.environ["DOWNLOAD_CACHE_BYTES"] = "0"
+    if not args.page_caches:
+        for name in ("DOC_CACHE_BYTES", "RENDER_CACHE_BYTES", "TEXT_CACHE_BYTES"):
+            os.environ[name] = "0"
+
+
+async def run_benchmarks(args) -> dict:
+    _configure_app_env(args)
+    import httpx
+    import main
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    print(f"Corpus in {args.corpus_dir}")
+    corpus = build_corpus(args.corpus_dir, sizes, main.CONVERT_FORMATS)
+    server, base = start_fixture_server(corpus["root"])
+    scenarios = build_scenarios(base, corpus, args.only)
+    print(f"{len(scenarios)} scenarios, fixtures at {base}")
+
+    results = []
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+                for scenario in scenarios:
+                    info = {k: scenario[k] for k in ("scenario", "endpoint", "corpus")}
+                    info["input_bytes"] = corpus["files"][scenario["corpus"]]["bytes"]
+                    runs = [await run_sequential(client, scenario, args.iterations, args.warmup)]
+                    if args.concurrency > 1:
+                        requests = args.requests or args.concurrency * 2
+                        runs.append(await run_concurrent(client, scenario, args.concurrency, requests))
+                    for run in runs:
+                        results.append({**info, **run})
+                        lat = run["latency_ms"]
+                        print(
+                            f"{scenario['scenario']:<44} {run['mode']:<10} p50={lat['p50']}ms p95={lat['p95']}ms "
+                            f"rps={run['throughput_rps']} rss={run['peak_rss_mb']}MB out={run['output_bytes']} "
+                            f"errors={run['errors']}"
+                        )
+    finally:
+        server.shutdown()
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+
+
+def compare(previous: dict, current: dict) -> None:
+    """Prints the p50 / throughput change of every scenario present in both runs."""
+    before = {(r["scenario"], r["mode"]): r for r in previous["results"]}
+    print(f"\nvs {previous['meta'].get('commit')} ({previous['meta'].get('timestamp')}):")
+    for result in current["results"]:
+        old = before.get((result["scenario"], result["mode"]))
+        if old is None or not old["latency_ms"]["p50"] or not result["latency_ms"]["p50"]:
+            continue
+        p50_old, p50_new = old["latency_ms"]["p50"], result["latency_ms"]["p50"]
+        change = (p50_new - p50_old) / p50_old * 100
+        print(f"{result['scenario']:<44} {result['mode']:<10} p50 {p50_old} -> {p50_new} ms ({change:+.1f}%)")
+
+
+def main_cli(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated PDF page counts")
+    parser.add_argument("--only", help="regex; only run scenarios (endpoint@corpus) matching it")
+    parser.add_argument("--iterations", type=int, default=5, help="sequential requests per scenario")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured requests before each scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent clients (1 = skip the load run)")
+    parser.add_argument("--requests", type=int, default=0, help="requests in the load run (default 2 x concurrency)")
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "fileway-bench-corpus"))
+    parser.add_argument("--download-cache", action="store_true", help="leave the download cache enabled")
+    parser.add_argument("--page-caches", action="store_true", help="leave the document / render / text caches enabled")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_benchmarks(args))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {len(report['results'])} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,760 +1,3764 @@
+import asyncio
+import collections
+import functools
+import hashlib
+import importlib
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
 import traceback
-from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
-from fastapi.responses import JSONResponse, StreamingResponse
+import uuid
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import AsyncExitStack, aclosing, asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+from fastapi import APIRouter, FastAPI, HTTPException, Request, UploadFile, File, Form
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from PyPDF2 import PdfMerger, PdfReader, PdfWriter
+from fastapi.routing import APIRoute
+from starlette.formparsers import MultiPartException, MultiPartParser
+from filelock import FileLock
 import fitz  # PyMuPDF
-from PIL import Image, ImageOps
-import requests
+from PIL import Image
+import httpx
 import io
+import puremagic
 import zipfile
 from fastapi.responses import HTMLResponse
 
-app = FastAPI()
+###==================================================================###
+# Observability: a level-gated logger (LOG_LEVEL) and in-process metrics served at /metrics
+# in the Prometheus text format. Handlers wrap their download / parse / render / encode /
+# archive / respond stages in stage(), which records a duration histogram per endpoint and
+# stage; metrics are per worker process and safe to update from the thread pool.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+log = logging.getLogger("fileway")
+log.setLevel(LOG_LEVEL)
+if not log.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log.addHandler(_log_handler)
+    log.propagate = False
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1 KB .. 1 GB
+ATTEMPTS_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+
+_metrics: list["Metric"] = []
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self._values.items()]
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), collect=None):
+        super().__init__(name, help_text, labels)
+        self._collect = collect  # optional: () -> {label tuple: value}, read at scrape time
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def samples(self) -> list[str]:
+        if self._collect is not None:
+            with self._lock:
+                self._values = dict(self._collect())
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels) -> None:
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+REQUESTS_IN_FLIGHT = Gauge("fileway_requests_in_flight", "HTTP requests currently being served.")
+REQUESTS = Counter("fileway_requests_total", "HTTP requests served, by route and status.", ("route", "status"))
+REQUEST_SECONDS = Histogram("fileway_request_duration_seconds", "Time to serve a request, body included.", ("route",))
+STAGE_SECONDS = Histogram("fileway_stage_duration_seconds", "Time spent per handler stage.", ("endpoint", "stage"))
+STAGE_BYTES = Histogram("fileway_stage_bytes", "Bytes produced per handler stage.", ("endpoint", "stage"), BYTES_BUCKETS)
+PAGES = Counter("fileway_pages_processed_total", "PDF pages parsed or rendered.", ("endpoint",))
+ENCODE_ATTEMPTS = Histogram(
+    "fileway_encode_attempts", "Encodes needed to hit a size target.", ("endpoint",), ATTEMPTS_BUCKETS
+)
+
+
+@contextmanager
+def stage(endpoint: str | None, name: str):
+    """Records the time spent in the block as `name` for `endpoint` (thread-safe)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, endpoint or "other", name)
+
+
+def record_bytes(endpoint: str | None, name: str, size: int) -> None:
+    STAGE_BYTES.observe(size, endpoint or "other", name)
+
+
+def timed(endpoint: str | None, name: str, fn):
+    """`fn`, recording each call as stage `name`; for work handed to the thread pool."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with stage(endpoint, name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class MetricsMiddleware:
+    """Counts requests in flight and times each one, splitting out the respond stage (body send)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+        respond_started = None
+        sent = 0
+
+        def route() -> str:
+            # the router records the matched route in the scope, so /jobs/{job_id} stays one label
+            matched = scope.get("route")
+            return getattr(matched, "path", "unmatched")
+
+        async def send_wrapper(message):
+            nonlocal status, respond_started, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                respond_started = time.perf_counter()
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    endpoint = route().strip("/")
+                    STAGE_SECONDS.observe(time.perf_counter() - respond_started, endpoint, "respond")
+                    record_bytes(endpoint, "respond", sent)
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            REQUESTS.inc(route(), str(status))
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route())
+
+
+###==================================================================###
+# Downloads: one pooled, keep-alive async client shared by every endpoint.
+
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", "10"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "2"))
+DOWNLOAD_MAX_CONNECTIONS = int(os.getenv("DOWNLOAD_MAX_CONNECTIONS", "100"))
+DOWNLOAD_MAX_KEEPALIVE = int(os.getenv("DOWNLOAD_MAX_KEEPALIVE", "20"))
+DOWNLOAD_PER_HOST = int(os.getenv("DOWNLOAD_PER_HOST", "8"))
+DOWNLOAD_FANOUT = int(os.getenv("DOWNLOAD_FANOUT", "8"))
+# Bodies are streamed, never buffered whole: each one is capped (DOWNLOAD_MAX_BYTES, or
+# DOWNLOAD_LIMIT_<ENDPOINT>), sniffed from its first bytes, and spooled to a temp file once
+# it outgrows DOWNLOAD_SPOOL_BYTES.
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+DOWNLOAD_SPOOL_BYTES = int(os.getenv("DOWNLOAD_SPOOL_BYTES", str(8 * 1024 * 1024)))
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+# enough for any signature; a PDF header may start anywhere in the first 1024 bytes
+MAGIC_BYTES = 2048
+
+# Statuses worth another attempt; anything else is handed back to the caller as-is.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_http_client: httpx.AsyncClient | None = None
+_host_slots: dict[str, asyncio.Semaphore] = {}
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(DOWNLOAD_TIMEOUT, connect=DOWNLOAD_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=DOWNLOAD_MAX_CONNECTIONS,
+                max_keepalive_connections=DOWNLOAD_MAX_KEEPALIVE,
+            ),
+        )
+    return _http_client
+
+
+def _host_slot(url: str) -> asyncio.Semaphore:
+    host = urlsplit(url).netloc
+    slot = _host_slots.get(host)
+    if slot is None:
+        slot = _host_slots[host] = asyncio.Semaphore(DOWNLOAD_PER_HOST)
+    return slot
+
+
+class DownloadRejected(HTTPException):
+    """413 / 415 for a download refused before it was transferred; endpoints pass it through as-is."""
+
+
+class Download:
+    """
+    A finished GET. For a 200, `content` is bytes, or a read-only memoryview over an mmapped
+    temp file when the body was too big to keep in memory; otherwise it is None.
+    """
+
+    def __init__(self, status_code: int, headers: httpx.Headers, content: bytes | memoryview | None = None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+def _download_limit(endpoint: str | None) -> int:
+    # e.g. DOWNLOAD_LIMIT_COMPRESS_PDF=52428800 overrides DOWNLOAD_MAX_BYTES for /compress-pdf
+    if endpoint is None:
+        return DOWNLOAD_MAX_BYTES
+    env_name = "DOWNLOAD_LIMIT_" + endpoint.upper().replace("-", "_")
+    return int(os.getenv(env_name, str(DOWNLOAD_MAX_BYTES)))
+
+
+def _check_magic(head: bytes, kind: str | None) -> None:
+    if kind == "pdf":
+        if b"%PDF-" not in head[:1024]:
+            raise DownloadRejected(status_code=415, detail="Downloaded file is not a PDF.")
+    elif kind == "image":
+        try:
+            matches = puremagic.magic_string(head)
+        except puremagic.PureError:
+            matches = []
+        if not any(m.mime_type.startswith("image/") or m.extension in (".eps", ".ps") for m in matches):
+            raise DownloadRejected(status_code=415, detail="Downloaded file is not a supported image.")
+
+
+def _too_large(limit: int) -> DownloadRejected:
+    return DownloadRejected(status_code=413, detail=f"File is larger than the {limit / (1024 * 1024):g} MB limit.")
+
+
+# mmap -> the file it maps, for sources whose file has a name (download cache objects)
+_source_paths: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _spooled_source(file, size: int, max_size: int, path: str | None = None) -> bytes | memoryview:
+    """
+    Contents of a SpooledTemporaryFile (or of the file at `path`): bytes while it's small,
+    else a view of an mmap.
+    """
+    if size <= max_size:
+        file.seek(0)
+        return file.read()
+    # the mapping stays valid after the file is closed (and its temp file deleted)
+    mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if path is not None:
+        _source_paths[mapping] = path
+    return memoryview(mapping)
+
+
+async def _read_body(response: httpx.Response, limit: int, kind: str | None) -> bytes | memoryview:
+    length = response.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit:
+        raise _too_large(limit)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_BYTES)
+    try:
+        head = b""
+        size = 0
+        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if size > limit:
+                raise _too_large(limit)
+            if len(head) < MAGIC_BYTES:
+                head += chunk[:MAGIC_BYTES - len(head)]
+                if len(head) == MAGIC_BYTES:
+                    _check_magic(head, kind)
+            spool.write(chunk)
+        if len(head) < MAGIC_BYTES:
+            _check_magic(head, kind)
+        return _spooled_source(spool, size, DOWNLOAD_SPOOL_BYTES)
+    finally:
+        spool.close()
+
+
+async def _get(url: str, headers: dict | None = None, limit: int = DOWNLOAD_MAX_BYTES, kind: str | None = None) -> Download:
+    """GET `url` through the shared client, retrying transient failures with backoff."""
+    client = _get_http_client()
+    attempt = 0
+    while True:
+        async with _host_slot(url):
+            try:
+                async with client.stream("GET", url, headers=headers) as response:
+                    if response.status_code not in RETRY_STATUSES or attempt >= DOWNLOAD_RETRIES:
+                        content = await _read_body(response, limit, kind) if response.status_code == 200 else None
+                        return Download(response.status_code, response.headers, content)
+            except httpx.TransportError:
+                if attempt >= DOWNLOAD_RETRIES:
+                    raise
+        await asyncio.sleep(0.25 * 2 ** attempt)
+        attempt += 1
+
+
+async def fetch(url: str, endpoint: str | None = None, kind: str | None = None) -> Download:
+    log.debug("Downloading: %s", url)
+    with stage(endpoint, "download"):
+        response = await _fetch(url, endpoint, kind)
+    if response.content is not None:
+        record_bytes(endpoint, "download", len(response.content))
+    return response
+
+
+async def _fetch(url: str, endpoint: str | None, kind: str | None) -> Download:
+    """
+    GET `url` for `endpoint`. The body is refused with a 413 past the endpoint's byte cap and
+    with a 415 as soon as its first bytes don't look like `kind` ("pdf" / "image"), instead
+    of after the whole transfer. Answered from the download cache when the origin confirms
+    (304) that the copy we hold for its ETag / Last-Modified is still current.
+    """
+    limit = _download_limit(endpoint)
+    if _download_cache is None:
+        return await _get(url, None, limit, kind)
+
+    entry = await run_in_thread(None, _download_cache.lookup, url)
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = await _get(url, headers, limit, kind)
+    if response.status_code == 304 and entry is not None:
+        content = await run_in_thread(None, _download_cache.read, entry)
+        if content is not None:
+            # cached for another endpoint, so its cap and kind haven't been checked yet
+            if len(content) > limit:
+                raise _too_large(limit)
+            _check_magic(bytes(content[:MAGIC_BYTES]), kind)
+            _download_cache.stats["hits"] += 1
+            return Download(200, httpx.Headers(entry["headers"]), content)
+        # evicted (possibly by another worker) between lookup and read
+        response = await _get(url, None, limit, kind)
+
+    _download_cache.stats["misses"] += 1
+    if response.status_code == 200 and ("etag" in response.headers or "last-modified" in response.headers):
+        await run_in_thread(None, _download_cache.store, url, response)
+    return response
+
+
+async def fetch_all(urls: list[str], endpoint: str | None = None, kind: str | None = None) -> list[Download]:
+    """Fetch `urls` concurrently (at most DOWNLOAD_FANOUT at a time), preserving order."""
+    fanout = asyncio.Semaphore(DOWNLOAD_FANOUT)
+
+    async def _one(url: str) -> Download:
+        async with fanout:
+            return await fetch(url, endpoint, kind)
+
+    return list(await asyncio.gather(*(_one(url) for url in urls)))
+
+
+async def fetch_as_completed(urls: list[str], endpoint: str | None = None, kind: str | None = None):
+    """Like fetch_all, but yields (index, download) as each one finishes instead of in order."""
+    fanout = asyncio.Semaphore(DOWNLOAD_FANOUT)
+
+    async def _one(index: int, url: str) -> tuple[int, Download]:
+        async with fanout:
+            return index, await fetch(url, endpoint, kind)
+
+    tasks = [asyncio.ensure_future(_one(index, url)) for index, url in enumerate(urls)]
+    try:
+        for done in asyncio.as_completed(tasks):
+            yield await done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+###==================================================================###
+# Download cache: users tend to run several tools on the same file in a row, so source
+# files are kept on disk and revalidated with a conditional GET instead of re-downloaded.
+#   objects/<sha256 of body>   file contents, shared by every URL that served the same bytes
+#   urls/<sha256 of url>.json  url -> object, plus the validators and headers it came with
+# Writes go through a temp file + os.replace, so readers never need the lock; the lock only
+# serialises eviction between uvicorn workers sharing the directory. LRU order is mtime,
+# which a hit refreshes.
+
+DOWNLOAD_CACHE_DIR = os.getenv("DOWNLOAD_CACHE_DIR", os.path.join(tempfile.gettempdir(), "fileway-downloads"))
+DOWNLOAD_CACHE_BYTES = int(os.getenv("DOWNLOAD_CACHE_BYTES", str(512 * 1024 * 1024)))
+
+# response headers worth replaying on a hit
+CACHED_HEADERS = ("content-type", "content-disposition", "etag", "last-modified")
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _evict_lru(directory: str, max_bytes: int, lock: FileLock) -> int:
+    """Deletes the least-recently-used (oldest mtime) files until `directory` fits in max_bytes."""
+    with lock:
+        files = []
+        for e in os.scandir(directory):
+            if e.is_file() and not e.name.startswith((".tmp-", ".lock")):
+                st = e.stat()
+                files.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            os.unlink(path)
+            total -= size
+            evicted += 1
+        return evicted
+
+
+class DownloadCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(root, "objects")
+        self.urls = os.path.join(root, "urls")
+        self.lock = FileLock(os.path.join(root, ".lock"))
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.urls, exist_ok=True)
+
+    def _entry_path(self, url: str) -> str:
+        return os.path.join(self.urls, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def lookup(self, url: str) -> dict | None:
+        try:
+            with open(self._entry_path(url), "rb") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def read(self, entry: dict) -> bytes | memoryview | None:
+        path = os.path.join(self.objects, entry["sha256"])
+        try:
+            with open(path, "rb") as f:
+                content = _spooled_source(f, os.fstat(f.fileno()).st_size, DOWNLOAD_SPOOL_BYTES, path)
+            os.utime(path)
+            os.utime(self._entry_path(entry["url"]))
+        except OSError:
+            return None
+        return content
+
+    def store(self, url: str, response: Download) -> None:
+        content = response.content
+        if len(content) > self.max_bytes:
+            return
+        sha = hashlib.sha256(content).hexdigest()
+        path = os.path.join(self.objects, sha)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            _write_atomic(path, content)
+        entry = {
+            "url": url,
+            "sha256": sha,
+            "size": len(content),
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+            "headers": {k: response.headers[k] for k in CACHED_HEADERS if k in response.headers},
+        }
+        _write_atomic(self._entry_path(url), json.dumps(entry).encode())
+        self.stats["stores"] += 1
+        self.evict()
+
+    def evict(self) -> None:
+        evicted = _evict_lru(self.objects, self.max_bytes, self.lock)
+        if not evicted:
+            return
+        self.stats["evictions"] += evicted
+
+        # forget urls whose object is gone so they are not revalidated for nothing
+        with self.lock:
+            for e in os.scandir(self.urls):
+                if not e.name.endswith(".json"):
+                    continue
+                try:
+                    with open(e.path, "rb") as f:
+                        sha = json.load(f)["sha256"]
+                except (OSError, ValueError, KeyError):
+                    sha = None
+                if sha is None or not os.path.exists(os.path.join(self.objects, sha)):
+                    os.unlink(e.path)
+
+    def usage(self) -> dict:
+        with self.lock:
+            sizes = [e.stat().st_size for e in os.scandir(self.objects) if not e.name.startswith(".tmp-")]
+        return {"objects": len(sizes), "bytes": sum(sizes), "max_bytes": self.max_bytes}
+
+
+_download_cache = DownloadCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_BYTES) if DOWNLOAD_CACHE_BYTES > 0 else None
+
+
+###==================================================================###
+# Workers: CPU-heavy work runs off the event loop so `/` and `/ping` keep answering.
+#   - thread pool: PIL / fitz calls (PIL releases the GIL while encoding/resizing)
+#   - process pool: pure-Python PyPDF2 work, which holds the GIL the whole time
+# Every endpoint also gets its own concurrency cap so one busy tool can't starve the rest.
+
+CPU_THREADS = int(os.getenv("CPU_THREADS", str(os.cpu_count() or 4)))
+CPU_PROCESSES = int(os.getenv("CPU_PROCESSES", str(os.cpu_count() or 2)))
+# Requests per endpoint doing CPU work at once. render_pages is paced by its consumer, so on
+# a streamed response (pdf-to-images' zip) a slow client holds its slot until the last chunk
+# is rendered; allow for that when sizing the rendering endpoints.
+ENDPOINT_CONCURRENCY = int(os.getenv("ENDPOINT_CONCURRENCY", "4"))
+
+# MuPDF is not thread-safe, so fitz calls made from the thread pool take this lock. It is
+# re-entrant because renderers that build PDFs take it themselves and may run under it.
+_fitz_lock = threading.RLock()
+
+_thread_pool: ThreadPoolExecutor | None = None
+_process_pool: ProcessPoolExecutor | None = None
+_endpoint_slots: dict[str, asyncio.Semaphore] = {}
+_endpoint_stats: dict[str, dict[str, int]] = {}
+
+for _field in ("running", "waiting"):
+    Gauge(
+        f"fileway_endpoint_{_field}",
+        f"Work items {_field} per endpoint concurrency cap.",
+        ("endpoint",),
+        collect=lambda field=_field: {(endpoint,): stats[field] for endpoint, stats in _endpoint_stats.items()},
+    )
+
+
+class WorkerError(Exception):
+    """Picklable stand-in for HTTPException, raised from process-pool workers."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=CPU_THREADS, thread_name_prefix="fileway-cpu")
+    return _thread_pool
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # spawn: forking a process that already runs the event loop and thread pool is unsafe
+        _process_pool = ProcessPoolExecutor(
+            max_workers=CPU_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+
+def _endpoint_limit(endpoint: str) -> int:
+    # e.g. CONCURRENCY_COMPRESS_PDF=2 overrides ENDPOINT_CONCURRENCY for /compress-pdf
+    env_name = "CONCURRENCY_" + endpoint.upper().replace("-", "_")
+    return int(os.getenv(env_name, str(ENDPOINT_CONCURRENCY)))
+
+
+@asynccontextmanager
+async def _endpoint_slot(endpoint: str):
+    slot = _endpoint_slots.get(endpoint)
+    if slot is None:
+        limit = _endpoint_limit(endpoint)
+        slot = _endpoint_slots[endpoint] = asyncio.Semaphore(limit)
+        _endpoint_stats[endpoint] = {"limit": limit, "running": 0, "waiting": 0, "completed": 0}
+    stats = _endpoint_stats[endpoint]
+    stats["waiting"] += 1
+    try:
+        await slot.acquire()
+    finally:
+        stats["waiting"] -= 1
+    stats["running"] += 1
+    try:
+        yield
+    finally:
+        stats["running"] -= 1
+        stats["completed"] += 1
+        slot.release()
+
+
+async def run_in_thread(endpoint: str | None, fn, *args, **kwargs):
+    """Run `fn` on the shared thread pool, within `endpoint`'s concurrency cap (None = uncapped)."""
+    loop = asyncio.get_running_loop()
+    if endpoint is None:
+        return await loop.run_in_executor(_get_thread_pool(), functools.partial(fn, *args, **kwargs))
+    async with _endpoint_slot(endpoint):
+        return await loop.run_in_executor(_get_thread_pool(), functools.partial(fn, *args, **kwargs))
+
+
+def _picklable(arg):
+    # memoryviews (mmapped uploads) can't cross the process boundary, so the worker gets a copy
+    if isinstance(arg, memoryview):
+        return arg.tobytes()
+    if isinstance(arg, list):
+        return [_picklable(item) for item in arg]
+    return arg
+
+
+async def run_in_process(endpoint: str, fn, *args, **kwargs):
+    """Run a module-level `fn` on the shared process pool, within `endpoint`'s concurrency cap."""
+    args = [_picklable(arg) for arg in args]
+    async with _endpoint_slot(endpoint):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(_get_process_pool(), functools.partial(fn, *args, **kwargs))
+        except WorkerError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+
+###==================================================================###
+# Streaming zip: every entry is sent as soon as it's ready instead of building the whole
+# archive in memory first. Already-compressed formats are stored as-is (deflating a JPEG
+# costs CPU and saves nothing); ZIP64 kicks in automatically for very large outputs.
+
+STORED_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "gif"}
+
+
+class _ZipSink(io.RawIOBase):
+    """Write-only, non-seekable target for zipfile; holds written bytes until drained."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipStream:
+    """
+    Incremental zip writer. zipfile sees a non-seekable sink, so it writes data descriptors
+    after each entry instead of seeking back to patch headers.
+    """
+
+    def __init__(self):
+        self._sink = _ZipSink()
+        self._zip = zipfile.ZipFile(self._sink, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def add(self, name: str, data: bytes, comment: bytes = b"") -> bytes:
+        """Adds one entry and returns the archive bytes produced for it."""
+        ext = name.rsplit(".", 1)[-1].lower()
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+        info.comment = comment
+        self._zip.writestr(info, data)
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        """Writes the central directory and returns the remaining archive bytes."""
+        self._zip.close()
+        return self._sink.drain()
+
+
+async def zip_streaming_response(endpoint: str, entries, filename: str) -> StreamingResponse:
+    """
+    Streams `entries` (an async iterator of (name, data) or (name, data, comment)) as a zip.
+    The first entry is produced before the response starts, so an error on it still turns
+    into a normal HTTP error instead of a truncated download.
+    """
+    entries = entries.__aiter__()
+    try:
+        first = await entries.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except BaseException:
+        await entries.aclose()
+        raise
+
+    async def body():
+        archive = ZipStream()
+        add = timed(endpoint, "archive", archive.add)
+        size = 0
+        try:
+            # The producer of `entries` already holds this endpoint's slot, so the (cheap)
+            # zip writes are left uncapped to avoid waiting on ourselves.
+            if first is not None:
+                chunk = await run_in_thread(None, add, *first)
+                size += len(chunk)
+                yield chunk
+                async for entry in entries:
+                    chunk = await run_in_thread(None, add, *entry)
+                    size += len(chunk)
+                    yield chunk
+            chunk = archive.close()
+            yield chunk
+            record_bytes(endpoint, "archive", size + len(chunk))
+        finally:
+            await entries.aclose()
+
+    return StreamingResponse(body(), media_type="application/zip", headers={
+        "Content-Disposition": f"attachment; filename={filename}"
+    })
+
+
+async def in_order(endpoint: str, fn, items: list):
+    """Runs `fn(item)` for every item concurrently on the thread pool, yielding results in order."""
+    tasks = [asyncio.ensure_future(run_in_thread(endpoint, fn, item)) for item in items]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+###==================================================================###
+# Page rendering: multi-page jobs are split into chunks of pages rendered on the process
+# pool. The PDF is spilled to a temp file once (hard-linked instead when it is a download
+# cache object) and each worker opens its own document from it (MuPDF reads lazily and the
+# OS page cache is shared); results come back in page order.
+# Two in-process caches let endpoints that see the same document share the work:
+#   documents: parsed fitz documents keyed by content hash, bounded by DOC_CACHE_BYTES
+#   renders:   raw RGB pixmaps keyed by (content hash, page, dpi, colorspace), bounded by
+#              RENDER_CACHE_BYTES; renderers only post-process a pixmap, so e.g. dark mode
+#              and pdf-to-images at the same dpi rasterise each page once between them
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(CPU_PROCESSES)))
+RENDER_CHUNK_PAGES = int(os.getenv("RENDER_CHUNK_PAGES", "4"))
+DOC_CACHE_BYTES = int(os.getenv("DOC_CACHE_BYTES", str(256 * 1024 * 1024)))
+RENDER_CACHE_BYTES = int(os.getenv("RENDER_CACHE_BYTES", str(512 * 1024 * 1024)))  # 0 disables
+
+# every renderer works on get_pixmap's default output: RGB, no alpha
+RENDER_COLORSPACE = "rgb"
+
+
+def content_key(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class DocumentCache:
+    """
+    LRU of open documents, bounded by the size of their source bytes. Callers hold
+    _fitz_lock while they use a document and must not modify it: it is shared.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        # key -> (doc, size), least recently used first
+        self._docs: collections.OrderedDict[str, tuple[fitz.Document, int]] = collections.OrderedDict()
+        self._used = 0
+
+    @contextmanager
+    def open(self, key: str, pdf, keep: bool = True):
+        """
+        The document for `key`, opened from `pdf` on a miss. With keep=False a miss is
+        opened for this call only, e.g. to read the page count of an upload the process pool
+        is going to render, which would otherwise stay pinned without ever being used.
+        """
+        item = self._docs.get(key)
+        if item is not None:
+            self._docs.move_to_end(key)
+            self.stats["hits"] += 1
+            yield item[0]
+            return
+
+        self.stats["misses"] += 1
+        # MuPDF reads the source in place; a memoryview keeps its mmap alive with the document
+        doc = fitz.open(stream=pdf, filetype="pdf")
+        size = len(pdf)
+        if not keep or size > self.max_bytes:
+            try:
+                yield doc
+            finally:
+                doc.close()
+            return
+
+        self._docs[key] = (doc, size)
+        self._used += size
+        while self._used > self.max_bytes:
+            _, (old_doc, old_size) = self._docs.popitem(last=False)
+            self._used -= old_size
+            old_doc.close()
+            self.stats["evictions"] += 1
+        yield doc
+
+    def usage(self) -> dict:
+        return {"entries": len(self._docs), "bytes": self._used, "max_bytes": self.max_bytes}
+
+
+class LRUCache:
+    """Thread-safe LRU of in-memory values, bounded by the sum of sizeof(value)."""
+
+    def __init__(self, max_bytes: int, sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        # key -> (value, size), least recently used first
+        self._items: collections.OrderedDict[tuple, tuple] = collections.OrderedDict()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: tuple) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def get(self, key: tuple):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            return item[0]
+
+    def put(self, key: tuple, value) -> None:
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._used -= old[1]
+            self._items[key] = (value, size)
+            self._used += size
+            self.stats["stores"] += 1
+            while self._used > self.max_bytes:
+                _, old = self._items.popitem(last=False)
+                self._used -= old[1]
+                self.stats["evictions"] += 1
+
+    def usage(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self._used, "max_bytes": self.max_bytes}
+
+
+_doc_cache = DocumentCache(DOC_CACHE_BYTES)
+# (width, height, samples) per page, sized by its samples
+_render_cache = LRUCache(RENDER_CACHE_BYTES, lambda pixmap: len(pixmap[2])) if RENDER_CACHE_BYTES > 0 else None
+
+
+def _render_pixmap(page: fitz.Page, dpi: int) -> tuple[int, int, bytes]:
+    pix = page.get_pixmap(dpi=dpi)  # type: ignore
+    return pix.width, pix.height, pix.samples
+
+
+def _page_jpeg(pixmap: tuple[int, int, bytes], dpi: int) -> bytes:
+    width, height, samples = pixmap
+    img = Image.frombytes("RGB", (width, height), samples)
+
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format="JPEG")
+    return img_buffer.getvalue()
+
+
+def _page_dark_pdf(pixmap: tuple[int, int, bytes], dpi: int, image_format: str = "flate", quality: int = 80) -> bytes:
+    """
+    Inverts a rendered page and returns it as a 1-page PDF, with the image either
+    flate-compressed (lossless) or JPEG-encoded. The pixmap goes straight into the page, so
+    there is no PIL round trip and no intermediate PNG.
+    """
+    width, height, samples = pixmap
+    with _fitz_lock:
+        # a fresh pixmap copies the samples, so the cached page isn't inverted with it
+        pix = fitz.Pixmap(fitz.csRGB, width, height, samples, 0)
+        pix.invert_irect()
+
+        out_pdf = fitz.open()
+        out_page = out_pdf.new_page(width=width * 72 / dpi, height=height * 72 / dpi)  # type: ignore
+        if image_format == "jpeg":
+            out_page.insert_image(out_page.rect, stream=pix.tobytes("jpeg", jpg_quality=quality))
+        else:
+            out_page.insert_image(out_page.rect, pixmap=pix)
+        return out_pdf.tobytes(deflate=True)
+
+
+def _page_rgb(pixmap: tuple[int, int, bytes], dpi: int) -> tuple[int, int, bytes]:
+    return pixmap
+
+
+def _doc_info(key: str, pdf) -> tuple[int, float, float]:
+    """Page count and first-page size in points (0 x 0 while the document is locked)."""
+    with _fitz_lock, _doc_cache.open(key, pdf, keep=False) as doc:
+        if doc.is_encrypted or not len(doc):
+            return len(doc), 0.0, 0.0
+        rect = doc[0].rect
+        return len(doc), rect.width, rect.height
+
+
+def _count_pages(key: str, pdf) -> int:
+    return _doc_info(key, pdf)[0]
+
+
+def _spill_to_tempfile(data, suffix: str) -> str:
+    """
+    A temp file with `data`, for the process pool. A source mapped from a named file is
+    hard-linked rather than copied; the link keeps it readable if the cache evicts it.
+    """
+    mapped = isinstance(data, memoryview) and isinstance(data.obj, mmap.mmap)
+    source = _source_paths.get(data.obj) if mapped else None
+    if source is not None:
+        path = os.path.join(tempfile.gettempdir(), f"fileway-{uuid.uuid4().hex}{suffix}")
+        try:
+            os.link(source, path)
+            return path
+        except OSError:
+            pass  # evicted meanwhile, or the cache lives on another filesystem
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix="fileway-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return path
+
+
+def _render_chunk(path: str, page_nums: list[int], renderer, dpi: int, keep: bool) -> list:
+    """
+    Process-pool worker: renders `page_nums` from its own copy of the document. Returns
+    (result, pixmap) per page, with the pixmap only when the caller wants to cache it.
+    """
+    doc = fitz.open(path)
+    try:
+        results = []
+        for page_num in page_nums:
+            pixmap = _render_pixmap(doc[page_num], dpi)
+            results.append((renderer(pixmap, dpi), pixmap if keep else None))
+        return results
+    finally:
+        doc.close()
+
+
+def _render_chunk_in_thread(key: str, pdf, page_nums: list[int], renderer, dpi: int, keep: bool) -> list:
+    # only rasterising needs the shared document; post-processing runs outside the lock
+    with _fitz_lock, _doc_cache.open(key, pdf) as doc:
+        pixmaps = [_render_pixmap(doc[page_num], dpi) for page_num in page_nums]
+    return [(renderer(pixmap, dpi), pixmap if keep else None) for pixmap in pixmaps]
+
+
+def _postprocess(renderer, pixmaps: list, dpi: int) -> list:
+    return [(renderer(pixmap, dpi), None) for pixmap in pixmaps]
+
+
+async def render_pages(
+    endpoint: str,
+    pdf,
+    renderer,
+    dpi: int,
+    *,
+    key: str | None = None,
+    workers: int | None = None,
+    chunk_pages: int | None = None,
+):
+    """
+    Yields `renderer(pixmap, dpi)` for every page, in page order. Up to `workers` chunks of
+    `chunk_pages` pages are in flight at once: chunks whose pixmaps are all in the render
+    cache are only post-processed on the thread pool, the rest are rendered on the process
+    pool (or, for 1-page documents and workers=1, on the thread pool from the cached
+    document, without the temp-file / IPC overhead). `key` is the content hash of `pdf`.
+
+    The endpoint's slot is held while pages are rendering. Since no more than `workers`
+    chunks run ahead of the consumer (which bounds the pages held in memory), a consumer that
+    stalls mid-document keeps its slot without rendering anything; once every chunk is
+    rendered the slot is released, before the remaining pages are handed over.
+    """
+    workers = max(1, workers or RENDER_WORKERS)
+    chunk_pages = max(1, chunk_pages or RENDER_CHUNK_PAGES)
+    # render time is what we spend waiting on chunks, not what the consumer spends per page
+    waited = 0.0
+
+    async with AsyncExitStack() as slot:
+        await slot.enter_async_context(_endpoint_slot(endpoint))
+        if key is None:
+            key = await run_in_thread(None, content_key, pdf)
+        page_count, width, height = await run_in_thread(None, _doc_info, key, pdf)
+        PAGES.inc(endpoint, amount=page_count)
+        chunks = [list(range(start, min(start + chunk_pages, page_count))) for start in range(0, page_count, chunk_pages)]
+
+        # Caching a document that can't fit as a whole would only churn the LRU on every pass.
+        cache_key = lambda page_num: (key, page_num, dpi, RENDER_COLORSPACE)
+        page_bytes = math.ceil(width * dpi / 72) * math.ceil(height * dpi / 72) * 3
+        keep = _render_cache is not None and 0 < page_bytes * page_count <= _render_cache.max_bytes
+        missing = _render_cache is None or any(cache_key(page_num) not in _render_cache for page_num in range(page_count))
+
+        path = None
+        if missing and page_count > 1 and workers > 1:
+            path = await run_in_thread(None, _spill_to_tempfile, pdf, ".pdf")
+        loop = asyncio.get_running_loop()
+
+        def submit(chunk: list[int]):
+            pixmaps = [_render_cache.get(cache_key(page_num)) for page_num in chunk] if _render_cache else [None]
+            if all(pixmap is not None for pixmap in pixmaps):
+                return loop.create_task(run_in_thread(None, _postprocess, renderer, pixmaps, dpi))
+            if path is None:
+                return loop.create_task(run_in_thread(None, _render_chunk_in_thread, key, pdf, chunk, renderer, dpi, keep))
+            return loop.run_in_executor(_get_process_pool(), _render_chunk, path, chunk, renderer, dpi, keep)
+
+        pending: collections.deque = collections.deque()
+        next_chunk = 0
+        try:
+            while next_chunk < len(chunks) or pending:
+                while next_chunk < len(chunks) and len(pending) < workers:
+                    pending.append((chunks[next_chunk], submit(chunks[next_chunk])))
+                    next_chunk += 1
+                chunk, future = pending.popleft()
+                started = time.perf_counter()
+                results = await future
+                waited += time.perf_counter() - started
+                if next_chunk == len(chunks) and all(other.done() for _, other in pending):
+                    await slot.aclose()  # nothing left to render, only pages to hand over
+                for page_num, (result, pixmap) in zip(chunk, results):
+                    if pixmap is not None:
+                        _render_cache.put(cache_key(page_num), pixmap)  # type: ignore
+                    yield result
+        finally:
+            for _, future in pending:
+                future.cancel()
+            if path is not None:
+                os.unlink(path)
+            STAGE_SECONDS.observe(waited, endpoint, "render")
+
+
+###==================================================================###
+# Result cache: every transform is a pure function of (input bytes, parameters), so retries
+# and double-clicks are answered from a cache keyed by sha256 of both. The key doubles as
+# the response ETag, which lets a client holding it get a 304 without any lookup at all.
+#   memory tier: per-worker LRU bounded by RESULT_CACHE_MEMORY_BYTES, entries expire after TTL
+#   disk tier:   what the memory tier evicts is spilled to RESULT_CACHE_DIR (shared by workers)
+# Endpoints whose output depends on a password (unlock / encrypt) are deliberately left out.
+
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "fileway-results"))
+RESULT_CACHE_MEMORY_BYTES = int(os.getenv("RESULT_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESULT_CACHE_MAX_ENTRY_BYTES", str(32 * 1024 * 1024)))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+
+# bump when an endpoint's output changes for the same inputs, to orphan old entries
+RESULT_CACHE_VERSION = "1"
+
+
+class ResultCache:
+    def __init__(self, root: str, memory_bytes: int, disk_bytes: int, max_entry_bytes: int, ttl: float):
+        self.root = root
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "not_modified": 0, "stores": 0, "spills": 0}
+        # key -> (expires_at, body, headers), least recently used first
+        self._memory: collections.OrderedDict[str, tuple[float, bytes, dict]] = collections.OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        if disk_bytes > 0:
+            os.makedirs(root, exist_ok=True)
+            self._disk_lock = FileLock(os.path.join(root, ".lock"))
+
+    def get(self, key: str) -> tuple[bytes, dict] | None:
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                if item[0] > now:
+                    self._memory.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return item[1], item[2]
+                del self._memory[key]
+                self._memory_used -= len(item[1])
+
+        item = self._read_disk(key, now)
+        if item is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["disk_hits"] += 1
+        expires, body, headers = item
+        self._put_memory(key, expires, body, headers)
+        return body, headers
+
+    def put(self, key: str, body: bytes, headers: dict) -> None:
+        if len(body) > self.max_entry_bytes:
+            return
+        self.stats["stores"] += 1
+        self._put_memory(key, time.time() + self.ttl, body, headers)
+
+    def _put_memory(self, key: str, expires: float, body: bytes, headers: dict) -> None:
+        spilled = []
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_used -= len(old[1])
+            self._memory[key] = (expires, body, headers)
+            self._memory_used += len(body)
+            while self._memory_used > self.memory_bytes and self._memory:
+                old_key, old = self._memory.popitem(last=False)
+                self._memory_used -= len(old[1])
+                spilled.append((old_key, *old))
+
+        now = time.time()
+        for old_key, old_expires, old_body, old_headers in spilled:
+            if old_expires > now:
+                self._write_disk(old_key, old_expires, old_body, old_headers)
+
+    # Disk entries are one file: a JSON header line ({expires, headers}) followed by the body.
+    def _write_disk(self, key: str, expires: float, body: bytes, headers: dict) -> None:
+        if self.disk_bytes <= 0 or len(body) > self.disk_bytes:
+            return
+        path = os.path.join(self.root, key)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        meta = json.dumps({"expires": expires, "headers": headers}).encode()
+        _write_atomic(path, meta + b"\n" + body)
+        self.stats["spills"] += 1
+        _evict_lru(self.root, self.disk_bytes, self._disk_lock)
+
+    def _read_disk(self, key: str, now: float) -> tuple[float, bytes, dict] | None:
+        if self.disk_bytes <= 0:
+            return None
+        path = os.path.join(self.root, key)
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+            if meta["expires"] <= now:
+                os.unlink(path)
+                return None
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return meta["expires"], body, meta["headers"]
+
+    def usage(self) -> dict:
+        with self._lock:
+            usage = {"memory_entries": len(self._memory), "memory_bytes": self._memory_used}
+        if self.disk_bytes > 0:
+            with self._disk_lock:
+                sizes = [e.stat().st_size for e in os.scandir(self.root) if not e.name.startswith((".tmp-", ".lock"))]
+            usage.update(disk_entries=len(sizes), disk_bytes=sum(sizes))
+        return usage
+
+
+_result_cache = (
+    ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MEMORY_BYTES, RESULT_CACHE_DISK_BYTES, RESULT_CACHE_MAX_ENTRY_BYTES, RESULT_CACHE_TTL)
+    if RESULT_CACHE_MEMORY_BYTES > 0 else None
+)
+
+
+def _result_key(endpoint: str, sources: list[bytes], params: dict, digests: list[bytes] | None = None) -> str:
+    key = hashlib.sha256(f"{RESULT_CACHE_VERSION}:{endpoint}".encode())
+    for digest in digests if digests is not None else (hashlib.sha256(source).digest() for source in sources):
+        key.update(digest)
+    key.update(json.dumps(params, sort_keys=True, separators=(",", ":")).encode())
+    return key.hexdigest()
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+
+
+async def cached_result(
+    request: Request, endpoint: str, sources: list[bytes], params: dict, digests: list[bytes] | None = None
+) -> tuple[str | None, Response | None]:
+    """
+    Looks up the output of `endpoint` for these inputs. Returns (key, response): response is
+    a 304 or the cached 200 when there is one, else None and the key goes to cache_result().
+    `params` must be the canonical (validated, defaulted) parameters the output depends on;
+    `digests` the sha256 digests of `sources`, when the caller hashed them already.
+    """
+    if _result_cache is None:
+        return None, None
+
+    key = await run_in_thread(None, _result_key, endpoint, sources, params, digests)
+    etag = f'"{key}"'
+    if _etag_matches(request, etag):
+        _result_cache.stats["not_modified"] += 1
+        return key, Response(status_code=304, headers={"ETag": etag})
+
+    hit = await run_in_thread(None, _result_cache.get, key)
+    if hit is None:
+        return key, None
+    body, headers = hit
+    return key, Response(body, headers={**headers, "ETag": etag, "X-Cache": "hit"})
+
+
+async def _tee_into_cache(key: str, body, headers: dict, request: Request | None = None):
+    """
+    Passes a streaming body through, caching it once it has been sent in full (and, with
+    `request`, only if the client is still there: the body may have ended early for it).
+    """
+    chunks: list[bytes] | None = []
+    size = 0
+    async for chunk in body:
+        if chunks is not None:
+            size += len(chunk)
+            if size <= _result_cache.max_entry_bytes:
+                chunks.append(chunk)
+            else:
+                chunks = None  # too big to keep; stop buffering
+        yield chunk
+    if chunks is not None and not (request is not None and await request.is_disconnected()):
+        await run_in_thread(None, _result_cache.put, key, b"".join(chunks), headers)
+
+
+async def cache_result(key: str | None, response: Response, request: Request | None = None) -> Response:
+    """
+    Stores a freshly computed 200 under `key` (from cached_result) and tags it with its ETag.
+    Pass `request` for a streaming body that stops early when the client disconnects.
+    """
+    if key is None or response.status_code != 200:
+        return response
+
+    headers = {k: v for k, v in response.headers.items() if k != "content-length"}
+    response.headers["ETag"] = f'"{key}"'
+    response.headers["X-Cache"] = "miss"
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = _tee_into_cache(key, response.body_iterator, headers, request)
+    else:
+        await run_in_thread(None, _result_cache.put, key, bytes(response.body), headers)
+    return response
+
+
+###==================================================================###
+# Uploads: every tool also has a multipart variant at <path>/upload, so a client can send the
+# file itself instead of hosting it somewhere for us to download. Starlette streams each file
+# part into a SpooledTemporaryFile that moves to disk above UPLOAD_SPOOL_BYTES; files that
+# did are handed on as a memoryview over an mmap of the temp file rather than read into bytes.
+# The larger spool only applies to the routes on the `uploads` router (see _UploadRoute), not
+# to Starlette process-wide.
+
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(8 * 1024 * 1024)))
+
+# _UploadRequest hooks into these Starlette internals; fail at import, not per request, if they move.
+assert hasattr(MultiPartParser, "spool_max_size") and hasattr(Request, "_get_form"), \
+    "Starlette's multipart internals changed; update _UploadRequest"
+
+
+class _UploadMultiPartParser(MultiPartParser):
+    spool_max_size = UPLOAD_SPOOL_BYTES
+
+
+class _UploadRequest(Request):
+    """A Request whose multipart form is parsed with _UploadMultiPartParser."""
+
+    async def _get_form(self, *, max_files=1000, max_fields=1000, max_part_size=1024 * 1024):
+        content_type = self.headers.get("content-type", "")
+        if self._form is None and content_type.startswith("multipart/form-data"):
+            parser = _UploadMultiPartParser(
+                self.headers, self.stream(), max_files=max_files, max_fields=max_fields, max_part_size=max_part_size
+            )
+            try:
+                self._form = await parser.parse()
+            except MultiPartException as exc:
+                raise HTTPException(status_code=400, detail=exc.message)
+        return await super()._get_form(max_files=max_files, max_fields=max_fields, max_part_size=max_part_size)
+
+
+class _UploadRoute(APIRoute):
+    """Hands the endpoint's form parsing an _UploadRequest instead of a plain Request."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def upload_handler(request: Request) -> Response:
+            return await handler(_UploadRequest(request.scope, request.receive))
+
+        return upload_handler
+
+
+# Every <path>/upload route is declared on this router; it's included into the app at the end.
+uploads = APIRouter(route_class=_UploadRoute)
+
+
+def upload_source(upload: UploadFile) -> bytes | memoryview:
+    """The uploaded file's contents: bytes while it was spooled in memory, else an mmap view."""
+    return _spooled_source(upload.file, upload.size or 0, UPLOAD_SPOOL_BYTES)
+
+
+def upload_sources(uploads: list[UploadFile]) -> list[bytes | memoryview]:
+    return [upload_source(upload) for upload in uploads]
+
+
+###==================================================================###
+# Warm-up: the office converters import docx / openpyxl / pptx (and load their default
+# templates) on first use, MuPDF sets itself up on the first render, and the process pool
+# only spawns its workers (each re-importing this module) when the first job arrives. A new
+# worker does all of that from the lifespan hook so no user request pays for it:
+#   WARMUP=background  serve at once; /ready answers 503 until warm-up has finished
+#   WARMUP=blocking    finish warm-up before accepting connections at all
+#   WARMUP=off         skip it; /ready is 200 from the start
+# Point the load balancer's readiness probe at /ready; /ping stays the liveness check.
+
+WARMUP = os.getenv("WARMUP", "background").lower()
+
+# imported lazily by the handlers that need them, timed one by one here
+WARMUP_MODULES = ("PyPDF2", "docx", "openpyxl", "pptx")
+
+_warmup: dict = {"state": "pending", "seconds": None, "steps": {}, "errors": {}}
+_warmup_task: asyncio.Task | None = None
+
+Gauge(
+    "fileway_warmup_step_seconds",
+    "Time each warm-up step took (imports, converter first use, process pool start).",
+    ("step",),
+    collect=lambda: {(step,): seconds for step, seconds in _warmup["steps"].items()},
+)
+Gauge("fileway_ready", "1 once this worker has finished warming up.", collect=lambda: {(): int(_warmup["state"] == "ready")})
+
+
+def _warm_fitz() -> None:
+    with _fitz_lock:
+        doc = fitz.open()
+        try:
+            doc.new_page().get_pixmap(dpi=36)
+        finally:
+            doc.close()
+
+
+def _warm_docx() -> None:
+    from docx import Document
+    Document()
+
+
+def _warm_openpyxl() -> None:
+    from openpyxl import Workbook
+    Workbook(write_only=True).create_sheet()
+
+
+def _warm_pptx() -> None:
+    from pptx import Presentation
+    Presentation()
+
+
+def _warm_process() -> int:
+    """Process-pool worker: the spawn already imported this module; add what workers use lazily."""
+    import PyPDF2  # noqa: F401
+    return os.getpid()
+
+
+def _timed(fn, *args) -> float:
+    started = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started
+
+
+async def _warm_process_pool() -> None:
+    # one call per worker at once: the pool spawns a new process for each call it can't hand
+    # to an idle one, so every worker is started (and has imported everything) up front
+    loop = asyncio.get_running_loop()
+    pool = _get_process_pool()
+    await asyncio.gather(*(loop.run_in_executor(pool, _warm_process) for _ in range(CPU_PROCESSES)))
+
+
+async def warm_up() -> None:
+    """Runs every warm-up step, recording how long each took; a failed step doesn't stop the rest."""
+    started = time.perf_counter()
+    steps = [(f"import {name}", importlib.import_module, name) for name in WARMUP_MODULES]
+    steps += [
+        ("fitz render", _warm_fitz),
+        ("docx document", _warm_docx),
+        ("openpyxl workbook", _warm_openpyxl),
+        ("pptx presentation", _warm_pptx),
+    ]
+    for step, fn, *args in steps:
+        try:
+            _warmup["steps"][step] = await run_in_thread(None, _timed, fn, *args)
+        except Exception as e:
+            _warmup["errors"][step] = str(e)
+            log.warning("warm-up: %s failed: %s", step, e)
+
+    step_started = time.perf_counter()
+    try:
+        await _warm_process_pool()
+        _warmup["steps"]["process pool"] = time.perf_counter() - step_started
+    except Exception as e:
+        _warmup["errors"]["process pool"] = str(e)
+        log.warning("warm-up: process pool failed: %s", e)
+
+    _warmup["seconds"] = time.perf_counter() - started
+    _warmup["state"] = "ready"
+    log.info(
+        "warm-up finished in %.2fs (%s)",
+        _warmup["seconds"],
+        ", ".join(f"{step} {seconds * 1000:.0f}ms" for step, seconds in _warmup["steps"].items()),
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _warmup_task
+    if WARMUP == "blocking":
+        await warm_up()
+    elif WARMUP == "background":
+        _warmup_task = asyncio.create_task(warm_up())
+    else:
+        _warmup["state"] = "ready"
+    yield
+    if _warmup_task is not None:
+        _warmup_task.cancel()
+        _warmup_task = None
+    await _stop_jobs()
+    global _http_client, _thread_pool, _process_pool
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.add_middleware(MetricsMiddleware)
+
+
+def route_errors(message: str | None = None):
+    """
+    Tool route decorator: HTTPExceptions (bad input, DownloadRejected, ...) pass through as they
+    are; anything else is logged with its traceback and answered with a 500 "<message>: <error>".
+    """
+    def decorate(handler):
+        @functools.wraps(handler)  # FastAPI reads the parameters through __wrapped__
+        async def wrapper(*args, **kwargs):
+            try:
+                return await handler(*args, **kwargs)
+            except HTTPException:
+                raise
+            except Exception as e:
+                log.exception("%s failed", handler.__name__)
+                raise HTTPException(status_code=500, detail=f"{message}: {e}" if message else str(e))
+        return wrapper
+    return decorate
+
+
+def _number_param(value, name: str, kind=int):
+    """`value` (e.g. a JSON string) as an int, or a float; a 400 naming `name` if it isn't one."""
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"{name} must be a number.")
+
+HTML = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <meta name="viewport" content="width=device-width, initial-scale=1.0">
+  <title>FileWay Backend</title>
+  <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;700&display=swap" rel="stylesheet">
+  <style>
+    body {
+      margin: 0;
+      padding: 0;
+      min-height: 100vh;
+      display: flex;
+      align-items: center;
+      justify-content: center;
+      background: #121212;
+      font-family: 'Inter', Arial, sans-serif;
+    }
+    .container {
+      background: #000;
+      border-radius: 18px;
+      box-shadow: 0 8px 32px rgba(20, 20, 40, 0.32);
+      padding: 48px 36px;
+      max-width: 420px;
+      text-align: center;
+    }
+    h1 {
+      font-size: 2.2rem;
+      font-weight: 700;
+      margin-bottom: 18px;
+      color: #74a1af;
+      letter-spacing: -1px;
+      line-height: 1.1;
+    }
+    .fileway {
+      font-size: 3.6rem;
+      font-weight: 800;
+      color: #943900;
+      letter-spacing: -2px;
+      display: inline-block;
+      margin: 10px 0 4px 0;
+    }
+    .backend {
+      color: #b8b8b8;
+    }
+    p {
+      font-size: 1.1rem;
+      color: #b8b8b8;
+      margin: 16px 0;
+    }
+    a {
+      color: #ff9800;
+      text-decoration: none;
+      font-weight: 600;
+      transition: color 0.2s;
+    }
+    a:hover {
+      color: #7a3306;
+      text-decoration: underline;
+    }
+    .status {
+      display: inline-block;
+      background: #1a1a1a;
+      color: #943900;
+      font-weight: 600;
+      border-radius: 8px;
+      padding: 4px 12px;
+      margin-bottom: 8px;
+      font-size: 1rem;
+      box-shadow: 0 2px 8px rgba(122,51,6,0.10);
+    }
+    .tagline {
+      font-size: 1.08rem;
+      color: #ffb26b;
+      font-weight: 500;
+      margin: 18px 0 0 0;
+      letter-spacing: 0.01em;
+      background: #1a1a1a;
+      border-radius: 8px;
+      padding: 10px 0 10px 0;
+      box-shadow: 0 2px 8px rgba(122,51,6,0.10);
+      text-align: center;
+      transition: background 0.2s;
+    }
+    .tagline .emoji {
+      font-size: 1.2em;
+      margin-left: 4px;
+    }
+  </style>
+</head>
+<body>
+  <div class="container">
+    <h1>
+      Welcome to <br>
+      <span class="fileway">FileWay</span><br>
+      backend
+    </h1>
+    <div class="status">Backend is running ✅</div>
+    <p>Go to <a href="https://fileway.vercel.app/" target="_blank">Frontend</a></p>
+    <div class="tagline">One-stop solution for all your file types <span class="emoji">⚡🛠️✨</span></div>
+  </div>
+</body>
+</html>
+"""
+
+
+
+
+@app.get("/", response_class=HTMLResponse)
+async def root():
+    return HTML
+
+
+@app.get("/ping")
+async def ping():
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness: 503 until warm-up has finished, with per-step timings either way."""
+    body = {
+        "status": _warmup["state"],
+        "seconds": _warmup["seconds"],
+        "steps_ms": {step: round(seconds * 1000, 1) for step, seconds in _warmup["steps"].items()},
+        "errors": _warmup["errors"],
+    }
+    return JSONResponse(body, status_code=200 if _warmup["state"] == "ready" else 503)
+
+
+@app.get("/workers")
+async def workers():
+    """Pool sizes plus per-endpoint running / waiting (queue depth) counters."""
+    return {
+        "threads": CPU_THREADS,
+        "processes": CPU_PROCESSES,
+        "queue_depth": sum(stats["waiting"] for stats in _endpoint_stats.values()),
+        "endpoints": _endpoint_stats,
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of this worker's metrics."""
+    body = "\n\n".join(metric.render() for metric in _metrics) + "\n"
+    return Response(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/cache")
+async def cache():
+    """Download / result cache counters (this worker) and disk usage (shared by workers)."""
+    downloads = results = renders = text = None
+    if _download_cache is not None:
+        downloads = {**_download_cache.stats, **await run_in_thread(None, _download_cache.usage)}
+    if _result_cache is not None:
+        results = {**_result_cache.stats, **await run_in_thread(None, _result_cache.usage)}
+    documents = {**_doc_cache.stats, **_doc_cache.usage()}
+    if _render_cache is not None:
+        renders = {**_render_cache.stats, **_render_cache.usage()}
+    if _text_cache is not None:
+        text = {**_text_cache.stats, **_text_cache.usage()}
+    return {"downloads": downloads, "results": results, "documents": documents, "renders": renders, "text": text}
+
+
+# Merge engines (MERGE_ENGINE, or "engine" per request):
+#   pymupdf  insert_pdf into one output document. Each input is hashed and parsed as soon as its
+#            download lands; once all are in and the result cache has missed, they are appended
+#            in the requested order, bookmarks included. Saved with garbage=4, which also merges
+#            identical objects across inputs, so a logo or font embedded in every input is stored once.
+#            That comparison is quadratic in the object count (~35s at 17k objects), so past
+#            MERGE_DEDUPE_MAX_OBJECTS the output only drops unused objects (garbage=2).
+#   pypdf2   PdfMerger in the process pool, after every download has finished.
+PDF_ENGINES = ("pymupdf", "pypdf2")
+MERGE_ENGINE = os.getenv("MERGE_ENGINE", "pymupdf")
+MERGE_DEDUPE_MAX_OBJECTS = int(os.getenv("MERGE_DEDUPE_MAX_OBJECTS", "5000"))
+
+
+def _pdf_engine(engine: str | None, default: str) -> str:
+    engine = (engine or default).lower()
+    if engine not in PDF_ENGINES:
+        raise HTTPException(status_code=400, detail="engine must be 'pymupdf' or 'pypdf2'.")
+    return engine
+
+
+def _merge_pdf_bytes(pdfs: list[bytes]) -> bytes:
+    from PyPDF2 import PdfMerger
+
+    merger = PdfMerger()
+    for pdf in pdfs:
+        merger.append(io.BytesIO(pdf))
+
+    output_pdf = io.BytesIO()
+    merger.write(output_pdf)
+    merger.close()
+    return output_pdf.getvalue()
+
+
+class FitzMerger:
+    """
+    Parses inputs as they arrive, in any order; the merged document is only built by
+    tobytes(), so a result cache hit skips the insert_pdf work. Use under _fitz_lock.
+    """
+
+    def __init__(self, count: int):
+        self._inputs: list[fitz.Document | None] = [None] * count
+
+    def add(self, index: int, pdf) -> None:
+        """Parses input `index`; password-protected inputs are refused right away."""
+        src = self._inputs[index] = fitz.open(stream=pdf, filetype="pdf")
+        if src.needs_pass:
+            raise HTTPException(status_code=400, detail="Merged PDFs must not be password protected.")
+
+    def tobytes(self) -> bytes:
+        """Appends the inputs in order (skipped ones are None), with their bookmarks, and saves."""
+        with fitz.open() as out:
+            toc: list = []
+            for src in self._inputs:
+                if src is None:
+                    continue
+                offset = out.page_count
+                toc += [[level, title, page + offset if page > 0 else page] for level, title, page in src.get_toc()]
+                out.insert_pdf(src)
+            if not out.page_count:
+                raise HTTPException(status_code=400, detail="None of the PDFs could be merged.")
+            if toc:
+                out.set_toc(toc)
+            garbage = 4 if out.xref_length() <= MERGE_DEDUPE_MAX_OBJECTS else 2
+            return out.tobytes(garbage=garbage, deflate=True)
+
+    def close(self) -> None:
+        for src in self._inputs:
+            if src is not None:
+                src.close()
+
+
+async def _in_order(pdfs: list):
+    for index, pdf in enumerate(pdfs):
+        yield index, pdf
+
+
+async def _merge_pdfs(request: Request, arrivals, count: int, engine: str) -> Response:
+    """
+    `arrivals` yields (index, pdf), or (index, None) for an input to skip, in any order. Each
+    input is hashed (and parsed, on pymupdf) as it lands, so by the time the last one is in
+    the result cache can be consulted without another pass over the bytes.
+    """
+    pdfs: list = [None] * count
+    digests: list = [None] * count
+    merger = FitzMerger(count) if engine == "pymupdf" else None
+    try:
+        parse_seconds = 0.0
+        async for index, pdf in arrivals:
+            if pdf is None:
+                continue
+            pdfs[index] = pdf
+            started = time.perf_counter()
+            if _result_cache is not None:
+                digests[index] = await run_in_thread(None, lambda: hashlib.sha256(pdf).digest())
+            if merger is not None:
+                await run_in_thread("merge-pdfs", _with_fitz, merger.add, index, pdf)
+            parse_seconds += time.perf_counter() - started
+        STAGE_SECONDS.observe(parse_seconds, "merge-pdfs", "parse")
+
+        sources = [pdf for pdf in pdfs if pdf is not None]
+        digests = [digest for digest in digests if digest is not None]
+        key, cached = await cached_result(request, "merge-pdfs", sources, {"engine": engine}, digests)
+        if cached is not None:
+            return cached
+
+        with stage("merge-pdfs", "encode"):
+            if merger is not None:
+                merged = await run_in_thread("merge-pdfs", _with_fitz, merger.tobytes)
+            else:  # parse + write both happen in the worker
+                merged = await run_in_process("merge-pdfs", _merge_pdf_bytes, sources)
+    finally:
+        if merger is not None:
+            await run_in_thread(None, _with_fitz, merger.close)
+    record_bytes("merge-pdfs", "encode", len(merged))
+
+    # one body, not StreamingResponse(BytesIO): that sends a chunk per line, each via the threadpool
+    return await cache_result(key, Response(merged, media_type="application/pdf", headers={
+        "Content-Disposition": "inline; filename=merged.pdf"
+    }))
+
+
+@app.post("/merge-pdfs")
+@route_errors("Error merging PDFs")
+async def merge_pdfs(request: Request):
+    body = await request.json()
+    pdf_urls = body.get("pdf_urls", [])
+
+    if not pdf_urls:
+        raise HTTPException(status_code=400, detail="No PDF URLs provided.")
+    engine = _pdf_engine(body.get("engine"), MERGE_ENGINE)
+
+    async def arrivals():
+        async with aclosing(fetch_as_completed(pdf_urls, "merge-pdfs", "pdf")) as downloads:
+            async for index, response in downloads:
+                if response.status_code == 200:
+                    yield index, response.content
+                else:
+                    log.warning("Failed to download: %s", pdf_urls[index])
+                    yield index, None
+
+    async with aclosing(arrivals()) as downloads:
+        return await _merge_pdfs(request, downloads, len(pdf_urls), engine)
+
+
+@uploads.post("/merge-pdfs/upload")
+@route_errors("Error merging PDFs")
+async def merge_pdfs_upload(request: Request, files: list[UploadFile] = File(...), engine: str | None = Form(None)):
+    return await _merge_pdfs(request, _in_order(upload_sources(files)), len(files), _pdf_engine(engine, MERGE_ENGINE))
+
+
+# Encryption engines for /unlock-pdf and /encrypt-pdf (CRYPT_ENGINE, or "engine" per request):
+#   pymupdf  MuPDF decrypts on open and re-encrypts while saving, with AES-256, in one pass over
+#            the objects; no page tree is rebuilt. Runs in a thread under _fitz_lock.
+#   pypdf2   PdfReader -> PdfWriter page by page in the process pool; encrypts with RC4-128.
+# Permissions are named flags ("print", "copy", ...) granted to whoever opens the file with the
+# user password; the owner password (default: the user password) always gets every one.
+CRYPT_ENGINE = os.getenv("CRYPT_ENGINE", "pymupdf")
+PDF_PERMISSIONS = {
+    "print": fitz.PDF_PERM_PRINT,
+    "print_hq": fitz.PDF_PERM_PRINT_HQ,
+    "modify": fitz.PDF_PERM_MODIFY,
+    "copy": fitz.PDF_PERM_COPY,
+    "annotate": fitz.PDF_PERM_ANNOTATE,
+    "form": fitz.PDF_PERM_FORM,
+    "accessibility": fitz.PDF_PERM_ACCESSIBILITY,
+    "assemble": fitz.PDF_PERM_ASSEMBLE,
+}
+# bits 7-8 and 13-32 of /P are reserved and must be 1; MuPDF sets them itself, PyPDF2 doesn't.
+# /P is a signed 32-bit integer, hence the negative value.
+PDF_PERMISSION_RESERVED_BITS = 0xFFFFF0C0 - (1 << 32)
+
+
+def _encrypt_params(password, owner_password=None, permissions=None) -> dict:
+    """Validates /encrypt-pdf options. permissions: list or comma-separated names, None = all."""
+    if isinstance(permissions, str):
+        permissions = [name for name in permissions.replace(" ", "").split(",") if name]
+    if permissions is None:
+        flags = sum(PDF_PERMISSIONS.values())
+    elif isinstance(permissions, list) and all(name in PDF_PERMISSIONS for name in permissions):
+        flags = sum({PDF_PERMISSIONS[name] for name in permissions})
+    else:
+        raise HTTPException(status_code=400, detail=f"permissions must be a list of: {', '.join(PDF_PERMISSIONS)}.")
+    return {"password": str(password), "owner_password": str(owner_password or password), "permissions": flags}
+
+
+def _fitz_encryption(params: dict) -> dict:
+    """tobytes() options that encrypt with AES-256 per _encrypt_params."""
+    return {
+        "encryption": fitz.PDF_ENCRYPT_AES_256,
+        "user_pw": params["password"],
+        "owner_pw": params["owner_password"],
+        "permissions": params["permissions"],
+    }
+
+
+def _has_encryption(doc: fitz.Document) -> bool:
+    """
+    Whether the file has an /Encrypt dictionary. doc.is_encrypted only says a password is
+    still needed, so it is False for an owner password with an empty user password.
+    """
+    return doc.xref_get_key(-1, "Encrypt")[0] != "null"
+
+
+def _unlock_pdf_fitz(pdf, password: str) -> bytes:
+    with fitz.open(stream=pdf, filetype="pdf") as doc:
+        if not _has_encryption(doc):
+            raise HTTPException(status_code=400, detail="PDF is not encrypted.")
+        if not doc.authenticate(password):
+            raise HTTPException(status_code=401, detail="Incorrect password.")
+        return doc.tobytes(encryption=fitz.PDF_ENCRYPT_NONE)
+
+
+def _unlock_pdf_bytes(pdf: bytes, password: str) -> bytes:
+    from PyPDF2 import PdfReader, PdfWriter
+
+    reader = PdfReader(io.BytesIO(pdf))
+
+    if not reader.is_encrypted:
+        raise WorkerError(400, "PDF is not encrypted.")
+
+    if reader.decrypt(password) == 0:
+        raise WorkerError(401, "Incorrect password.")
+
+    writer = PdfWriter()
+    for page in reader.pages:
+        writer.add_page(page)
+
+    output_pdf = io.BytesIO()
+    writer.write(output_pdf)
+    return output_pdf.getvalue()
+
+
+async def _unlock_pdf(pdf, password: str, engine: str) -> Response:
+    with stage("unlock-pdf", "encode"):  # parse + write both happen in one call
+        if engine == "pymupdf":
+            unlocked = await run_in_thread("unlock-pdf", _with_fitz, _unlock_pdf_fitz, pdf, password)
+        else:
+            unlocked = await run_in_process("unlock-pdf", _unlock_pdf_bytes, pdf, password)
+    record_bytes("unlock-pdf", "encode", len(unlocked))
+
+    return Response(unlocked, media_type="application/pdf", headers={
+        "Content-Disposition": "inline; filename=unlocked.pdf"
+    })
+
+
+@app.post("/unlock-pdf")
+@route_errors("Error unlocking PDF")
+async def unlock_pdf(request: Request):
+    body = await request.json()
+    pdf_url = body.get("pdf_urls")
+    password = body.get("password")
+
+    if not pdf_url:
+        raise HTTPException(status_code=400, detail="URL are required.")
+    if  not password:
+        raise HTTPException(status_code=400, detail="password are required.")
+    engine = _pdf_engine(body.get("engine"), CRYPT_ENGINE)
+
+    if isinstance(pdf_url, list):
+     pdf_url = pdf_url[0]
+
+    response = await fetch(pdf_url, "unlock-pdf", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
+
+    return await _unlock_pdf(response.content, password, engine)
+
+
+@uploads.post("/unlock-pdf/upload")
+@route_errors("Error unlocking PDF")
+async def unlock_pdf_upload(file: UploadFile = File(...), password: str = Form(...), engine: str | None = Form(None)):
+    return await _unlock_pdf(upload_source(file), password, _pdf_engine(engine, CRYPT_ENGINE))
+
+
+def _split_pdf_bytes(pdf: bytes, start: int, end: int) -> bytes:
+    from PyPDF2 import PdfReader, PdfWriter
+
+    reader = PdfReader(io.BytesIO(pdf))
+
+    if start < 1 or end > len(reader.pages) or start > end:
+        raise WorkerError(400, "Invalid page range.")
+
+    writer = PdfWriter()
+    for i in range(start - 1, end):  # PDF page numbers are 0-based
+        writer.add_page(reader.pages[i])
+
+    output_pdf = io.BytesIO()
+    writer.write(output_pdf)
+    return output_pdf.getvalue()
+
+
+async def _split_pdf(request: Request, pdf, start: int, end: int) -> Response:
+    key, cached = await cached_result(request, "split-pdf", [pdf], {"start": start, "end": end})
+    if cached is not None:
+        return cached
+
+    with stage("split-pdf", "encode"):  # parse + write both happen in the worker
+        split = await run_in_process("split-pdf", _split_pdf_bytes, pdf, start, end)
+    record_bytes("split-pdf", "encode", len(split))
+
+    return await cache_result(key, StreamingResponse(io.BytesIO(split), media_type="application/pdf", headers={
+        "Content-Disposition": "inline; filename=split_pages.pdf"
+    }))
+
+
+# Multi-part split: several ranges, every N pages, or one part per top-level bookmark. The
+# source is parsed once; each part gets only the objects its own pages reference
+# (insert_pdf into a fresh document, then garbage collection), and the parts are streamed
+# back as a zip while the next one is being written.
+SPLIT_MAX_PARTS = int(os.getenv("SPLIT_MAX_PARTS", "1000"))
+
+
+def _parse_ranges(ranges) -> list[list[int]]:
+    """Accepts "1-3,5,8-9", ["1-3", "5"], [[1, 3], [5, 5]] or [{"start": 1, "end": 3}]."""
+    if isinstance(ranges, str):
+        ranges = [item for item in ranges.split(",") if item.strip()]
+    if not isinstance(ranges, list) or not ranges:
+        raise HTTPException(status_code=400, detail="ranges must be a non-empty list of page ranges.")
+
+    parsed = []
+    for item in ranges:
+        try:
+            if isinstance(item, dict):
+                start, end = int(item["start"]), int(item["end"])
+            elif isinstance(item, list):
+                start, end = int(item[0]), int(item[-1])
+            else:
+                first, _, last = str(item).partition("-")
+                start = int(first)
+                end = int(last) if last.strip() else start
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail=f"Invalid page range: {item!r}.")
+        parsed.append([start, end])
+    return parsed
+
+
+def _split_params(start, end, ranges, every, bookmarks) -> dict:
+    """
+    Picks the split mode; exactly one of start/end, ranges, every or bookmarks is allowed.
+    start, end and every may still be strings.
+    """
+    modes = [
+        mode
+        for mode, given in (
+            ("range", start is not None or end is not None),
+            ("ranges", bool(ranges)),
+            ("every", every is not None),
+            ("bookmarks", bool(bookmarks)),
+        )
+        if given
+    ]
+    if len(modes) != 1:
+        raise HTTPException(status_code=400, detail="Give exactly one of start/end, ranges, every or bookmarks.")
+
+    mode = modes[0]
+    if mode == "range":
+        if start is None or end is None:
+            raise HTTPException(status_code=400, detail="Missing page range.")
+        return {"mode": mode, "start": _number_param(start, "start"), "end": _number_param(end, "end")}
+    if mode == "ranges":
+        parsed = _parse_ranges(ranges)
+        if len(parsed) > SPLIT_MAX_PARTS:
+            raise HTTPException(status_code=400, detail=f"At most {SPLIT_MAX_PARTS} ranges are allowed.")
+        return {"mode": mode, "ranges": parsed}
+    if mode == "every":
+        every = _number_param(every, "every")
+        if every < 1:
+            raise HTTPException(status_code=400, detail="every must be at least 1.")
+        return {"mode": mode, "every": every}
+    return {"mode": mode}
+
+
+def _part_filename(title: str) -> str:
+    name = "".join(c if c.isalnum() or c in " -_" else "_" for c in title).strip()
+    return name[:80] or "untitled"
+
+
+def _split_parts(doc: fitz.Document, params: dict) -> list[tuple[str, int, int]]:
+    """(file name, first page, last page) per part, 1-based and inclusive."""
+    if doc.needs_pass:
+        raise HTTPException(status_code=400, detail="PDF is password protected.")
+    page_count = doc.page_count
+
+    if params["mode"] == "ranges":
+        parts = [(f"pages_{start}-{end}.pdf", start, end) for start, end in params["ranges"]]
+        if any(start < 1 or end > page_count or start > end for _, start, end in parts):
+            raise HTTPException(status_code=400, detail="Invalid page range.")
+        return parts
+
+    if params["mode"] == "every":
+        every = params["every"]
+        parts = []
+        for start in range(1, page_count + 1, every):
+            end = min(start + every - 1, page_count)
+            parts.append((f"pages_{start}-{end}.pdf", start, end))
+    else:
+        starts = sorted(
+            ((page, title) for level, title, page, *_ in doc.get_toc() if level == 1 and 1 <= page <= page_count),
+            key=lambda entry: entry[0],
+        )
+        if not starts:
+            raise HTTPException(status_code=400, detail="PDF has no bookmarks to split by.")
+        if starts[0][0] > 1:
+            starts.insert(0, (1, "Front matter"))
+
+        parts = []
+        for i, (start, title) in enumerate(starts):
+            end = starts[i + 1][0] - 1 if i + 1 < len(starts) else page_count
+            if end >= start:  # several bookmarks on one page: the last one gets it
+                parts.append((f"{len(parts) + 1:02d}_{_part_filename(title)}.pdf", start, end))
+
+    if len(parts) > SPLIT_MAX_PARTS:
+        raise HTTPException(status_code=400, detail=f"That would make {len(parts)} parts; at most {SPLIT_MAX_PARTS} are allowed.")
+    return parts
+
+
+def _split_part_bytes(doc: fitz.Document, start: int, end: int) -> bytes:
+    part = fitz.open()
+    try:
+        part.insert_pdf(doc, from_page=start - 1, to_page=end - 1)
+        return part.tobytes(garbage=3, deflate=True)
+    finally:
+        part.close()
+
+
+async def _split_pdf_parts(request: Request, pdf, params: dict) -> Response:
+    key, cached = await cached_result(request, "split-pdf", [pdf], params)
+    if cached is not None:
+        return cached
+
+    with stage("split-pdf", "parse"):
+        doc = await run_in_thread("split-pdf", _with_fitz, lambda: fitz.open(stream=pdf, filetype="pdf"))
+        try:
+            parts = await run_in_thread("split-pdf", _with_fitz, _split_parts, doc, params)
+        except BaseException:
+            await run_in_thread(None, _with_fitz, doc.close)
+            raise
+
+    async def entries():
+        try:
+            for name, start, end in parts:
+                with stage("split-pdf", "encode"):
+                    part = await run_in_thread("split-pdf", _with_fitz, _split_part_bytes, doc, start, end)
+                record_bytes("split-pdf", "encode", len(part))
+                yield name, part
+        finally:
+            await run_in_thread(None, _with_fitz, doc.close)
+
+    return await cache_result(key, await zip_streaming_response("split-pdf", entries(), "split_pages.zip"))
+
+
+@app.post("/split-pdf")
+@route_errors("Error splitting PDF")
+async def split_pdf(request: Request):
+    """
+    One range (start/end) returns that PDF; ranges, every or bookmarks return a zip of parts.
+    """
+    body = await request.json()
+    pdf_url = body.get("pdf_urls") # type: ignore
+
+    if not pdf_url:
+        raise HTTPException(status_code=400, detail="Missing url")
+    params = _split_params(body.get("start"), body.get("end"), body.get("ranges"), body.get("every"), body.get("bookmarks"))
+    if isinstance(pdf_url, list):
+     pdf_url = pdf_url[0]  #
+
+
+
+    # Download the PDF
+    response = await fetch(pdf_url, "split-pdf", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
+
+    if params["mode"] == "range":
+        return await _split_pdf(request, response.content, params["start"], params["end"])
+    return await _split_pdf_parts(request, response.content, params)
+
+
+@uploads.post("/split-pdf/upload")
+@route_errors("Error splitting PDF")
+async def split_pdf_upload(
+    request: Request,
+    file: UploadFile = File(...),
+    start: str | None = Form(None),
+    end: str | None = Form(None),
+    ranges: str | None = Form(None),
+    every: str | None = Form(None),
+    bookmarks: bool = Form(False),
+):
+    """`ranges` is "1-3,5,8-9" or the same JSON list /split-pdf takes."""
+    if ranges and ranges.lstrip().startswith("["):
+        try:
+            ranges = json.loads(ranges)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="ranges must be a JSON list or like \"1-3,5\".")
+    params = _split_params(start, end, ranges, every, bookmarks)
+    if params["mode"] == "range":
+        return await _split_pdf(request, upload_source(file), params["start"], params["end"])
+    return await _split_pdf_parts(request, upload_source(file), params)
+
+
+DARK_MODE_DPI = int(os.getenv("DARK_MODE_DPI", "150"))
+DARK_MODE_JPEG_QUALITY = int(os.getenv("DARK_MODE_JPEG_QUALITY", "80"))
+
+
+def _join_page_docs(pages: list[bytes]) -> fitz.Document:
+    """Concatenates 1-page PDFs; their (already compressed) streams are copied as-is."""
+    out_pdf = fitz.open()
+    for page_pdf in pages:
+        with fitz.open(stream=page_pdf, filetype="pdf") as src:
+            out_pdf.insert_pdf(src)
+    return out_pdf
+
+
+def _join_page_pdfs(pages: list[bytes]) -> bytes:
+    with _fitz_lock:
+        out_pdf = _join_page_docs(pages)
+        output_buffer = io.BytesIO()
+        out_pdf.save(output_buffer)
+        out_pdf.close()
+    return output_buffer.getvalue()
+
+
+# mode=vector: a page-sized white fill painted last with the Difference blend mode turns
+# every colour c underneath into 1 - c, so no pixels need to be rendered at all. Pages that
+# use blending are composited as an isolated group, so an opaque white backdrop goes first
+# or the empty parts of the page would have nothing to invert.
+_DARK_GSTATE = "<</BM/Difference>>"
+_DARK_BACKDROP = b"q 1 1 1 rg -10000 -10000 20000 20000 re f Q"
+_DARK_OVERLAY = b"q /fwDark gs 1 1 1 rg -10000 -10000 20000 20000 re f Q"
+
+
+def _add_page_gstate(doc: fitz.Document, page: fitz.Page, name: str, gstate: str) -> None:
+    """Registers `gstate` as /ExtGState/<name> in the page's resources."""
+    res_kind, res = doc.xref_get_key(page.xref, "Resources")
+    if res_kind == "null":
+        # inherited from the page tree: give the page its own entry pointing at the same resources
+        parent = page.xref
+        while res_kind == "null":
+            parent_kind, parent_ref = doc.xref_get_key(parent, "Parent")
+            if parent_kind != "xref":
+                res_kind, res = "dict", "<<>>"
+                break
+            parent = int(parent_ref.split()[0])
+            res_kind, res = doc.xref_get_key(parent, "Resources")
+        doc.xref_set_key(page.xref, "Resources", res)
+
+    # xref_set_key can't write through indirect objects, so follow them by hand
+    target, path = (int(res.split()[0]), "") if res_kind == "xref" else (page.xref, "Resources/")
+    gs_kind, gs = doc.xref_get_key(target, path + "ExtGState")
+    if gs_kind == "xref":
+        target, path = int(gs.split()[0]), ""
+    else:
+        path += "ExtGState/"
+    doc.xref_set_key(target, path + name, gstate)
+
+
+def _vector_dark_mode_doc(doc: fitz.Document) -> None:
+    """
+    Dark mode without rasterising: each page's content is wrapped in q/Q, put on a white
+    backdrop and followed by one shared overlay stream that inverts everything (text,
+    vector art and embedded images) via the Difference blend mode. The original content
+    is untouched, so text stays selectable and the cost is per page, not per pixel.
+    """
+    backdrop, overlay = doc.get_new_xref(), doc.get_new_xref()
+    for xref, stream in ((backdrop, _DARK_BACKDROP), (overlay, _DARK_OVERLAY)):
+        doc.update_object(xref, "<<>>")
+        doc.update_stream(xref, stream)
+
+    for page in doc:
+        page.wrap_contents()
+        _add_page_gstate(doc, page, "fwDark", _DARK_GSTATE)
+
+        kind, contents = doc.xref_get_key(page.xref, "Contents")
+        if kind == "array":
+            contents = contents[1:-1]
+        elif kind != "xref":
+            contents = ""
+        doc.xref_set_key(page.xref, "Contents", f"[{backdrop} 0 R {contents} {overlay} 0 R]")
+
+
+def _vector_dark_mode_pdf_bytes(pdf: bytes) -> bytes:
+    with _fitz_lock:
+        doc = fitz.open(stream=pdf, filetype="pdf")
+        try:
+            _vector_dark_mode_doc(doc)
+            return doc.tobytes(garbage=1, deflate=True)
+        finally:
+            doc.close()
+
+
+def _dark_mode_params(mode: str | None, dpi: int | str, image_format: str | None, quality: int | str) -> dict:
+    """
+    Validates the options (numbers may still be strings) and returns only the ones the
+    chosen mode actually uses.
+    """
+    mode = (mode or "raster").lower()
+    image_format = (image_format or "flate").lower()
+
+    if mode not in ("raster", "vector"):
+        raise HTTPException(status_code=400, detail="mode must be 'raster' or 'vector'")
+    dpi = _number_param(dpi, "dpi")
+    if not 36 <= dpi <= 600:
+        raise HTTPException(status_code=400, detail="dpi must be between 36 and 600")
+    if image_format not in ("flate", "jpeg"):
+        raise HTTPException(status_code=400, detail="image_format must be 'flate' or 'jpeg'")
+
+    if mode == "vector":
+        return {"mode": mode}
+    params = {"mode": mode, "dpi": dpi, "image_format": image_format}
+    if image_format == "jpeg":
+        params["quality"] = quality = _number_param(quality, "quality")
+        if not 1 <= quality <= 100:
+            raise HTTPException(status_code=400, detail="quality must be between 1 and 100")
+    return params
+
+
+async def _dark_mode(request: Request, pdf, params: dict) -> Response:
+    key, cached = await cached_result(request, "dark-mode-pdf", [pdf], params)
+    if cached is not None:
+        return cached
+
+    if params["mode"] == "vector":
+        with stage("dark-mode-pdf", "encode"):
+            dark = await run_in_thread("dark-mode-pdf", _vector_dark_mode_pdf_bytes, pdf)
+    else:
+        renderer = functools.partial(
+            _page_dark_pdf,
+            image_format=params["image_format"],
+            quality=params.get("quality", DARK_MODE_JPEG_QUALITY),
+        )
+        async with aclosing(render_pages("dark-mode-pdf", pdf, renderer, params["dpi"])) as rendered:
+            pages = [page async for page in rendered]
+        with stage("dark-mode-pdf", "encode"):
+            dark = await run_in_thread("dark-mode-pdf", _join_page_pdfs, pages)
+    record_bytes("dark-mode-pdf", "encode", len(dark))
+
+    return await cache_result(key, StreamingResponse(io.BytesIO(dark), media_type="application/pdf", headers={
+        "Content-Disposition": "inline; filename=dark_mode.pdf"
+    }))
+
+
+@app.post("/dark-mode-pdf")
+@route_errors("Error")
+async def convert_to_dark_mode(request: Request):
+    data = await request.json()
+    pdf_url = data.get("pdf_urls")
+    if not pdf_url:
+        raise HTTPException(status_code=400, detail="Missing PDF URL")
+    if isinstance(pdf_url, list):
+        pdf_url = pdf_url[0]  # ✅ Take the first item
+
+    params = _dark_mode_params(
+        data.get("mode"),
+        data.get("dpi", DARK_MODE_DPI),
+        data.get("image_format"),
+        data.get("quality", DARK_MODE_JPEG_QUALITY),
+    )
+
+    response = await fetch(pdf_url, "dark-mode-pdf", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF")
+
+    return await _dark_mode(request, response.content, params)
+
+
+@uploads.post("/dark-mode-pdf/upload")
+@route_errors("Error")
+async def convert_to_dark_mode_upload(
+    request: Request,
+    file: UploadFile = File(...),
+    mode: str = Form("raster"),
+    dpi: int | str = Form(DARK_MODE_DPI),
+    image_format: str = Form("flate"),
+    quality: int | str = Form(DARK_MODE_JPEG_QUALITY),
+):
+    params = _dark_mode_params(mode, dpi, image_format, quality)
+    return await _dark_mode(request, upload_source(file), params)
+
+
+# JPEG qualities /compress-pdf chooses from, lowest first (the old sweep tried 80, 75, ... 10).
+COMPRESS_QUALITIES = list(range(10, 85, 5))
+COMPRESS_DPI = 100  # Lower DPI = smaller file
+# Raster compression keeps every page's RGB samples while it searches for a quality, so the
+# pixels it takes on are capped (413 beyond); 512 MB is ~180 letter pages at COMPRESS_DPI.
+COMPRESS_MAX_RASTER_BYTES = int(os.getenv("COMPRESS_MAX_RASTER_BYTES", str(512 * 1024 * 1024)))
+# how much a page's PDF wrapping can grow between qualities (the digits of its /Length)
+JPEG_PAGE_SLACK_BYTES = 4
+
+
+def _check_raster_budget(page_count: int, width: float, height: float) -> None:
+    """413s a raster compress whose pixmaps (sized after the first page) exceed the cap."""
+    raster_bytes = page_count * math.ceil(width * COMPRESS_DPI / 72) * math.ceil(height * COMPRESS_DPI / 72) * 3
+    if raster_bytes > COMPRESS_MAX_RASTER_BYTES:
+        limit_mb = COMPRESS_MAX_RASTER_BYTES / (1024 * 1024)
+        raise HTTPException(status_code=413, detail=f"Too many pages to compress: over the {limit_mb:g} MB raster limit.")
+
+
+def _jpeg_pages(pages: list[Image.Image], quality: int) -> list[bytes]:
+    jpegs = []
+    for img in pages:
+        img_io = io.BytesIO()
+        img.save(img_io, format="JPEG", quality=quality)
+        jpegs.append(img_io.getvalue())
+    return jpegs
+
+
+def _jpeg_pages_pdf(pages: list[Image.Image], jpegs: list[bytes]) -> bytes:
+    with _fitz_lock:
+        compressed_pdf = fitz.open()
+        for img, jpeg in zip(pages, jpegs):
+            rect = fitz.Rect(0, 0, img.width, img.height)
+            new_page = compressed_pdf.new_page(width=rect.width, height=rect.height) # type: ignore
+            new_page.insert_image(rect, stream=jpeg)
+        output_stream = io.BytesIO()
+        compressed_pdf.save(output_stream)
+        compressed_pdf.close()
+    return output_stream.getvalue()
+
+
+def _compress_pdf_bytes(rgb_pages: list[tuple[int, int, bytes]], target_kb: float) -> tuple[bytes | None, int, float, dict]:
+    """
+    Takes every page rendered once, as (width, height, RGB samples), and searches
+    COMPRESS_QUALITIES for the highest JPEG quality whose PDF fits in target_kb. The first encode (highest quality) seeds a
+    size estimate for the second probe, after which it's a safeguarded interpolation /
+    bisection search, so each page is encoded O(log n) times instead of once per step.
+    Only the first probe and the winner are built into a PDF (under _fitz_lock): the PDF
+    around the JPEG streams is the same at every quality, so the other probes are sized as
+    their JPEGs plus that overhead, and only built when that lands within
+    JPEG_PAGE_SLACK_BYTES per page of the target.
+    Returns (pdf_bytes, quality, size_kb, stats); pdf_bytes is None if the target can't be
+    met, in which case quality/size_kb describe the smallest result we got.
+    """
+    started = time.perf_counter()
+    # frombuffer wraps the samples without copying them
+    pages = [Image.frombuffer("RGB", (width, height), samples, "raw", "RGB", 0, 1) for width, height, samples in rgb_pages]
+
+    sizes_kb: dict[int, float] = {}
+    best_fit: tuple[int, list[bytes]] | None = None
+    built: tuple[int, bytes] | None = None
+    overhead = 0
+
+    def probe(idx: int) -> bool:
+        nonlocal best_fit, built, overhead
+        quality = COMPRESS_QUALITIES[idx]
+        jpegs = _jpeg_pages(pages, quality)
+        size = sum(len(jpeg) for jpeg in jpegs) + overhead
+        if built is None or abs(size - target_kb * 1024) <= JPEG_PAGE_SLACK_BYTES * len(jpegs):
+            built = (idx, _jpeg_pages_pdf(pages, jpegs))
+            overhead = len(built[1]) - (size - overhead)
+            size = len(built[1])
+        size_kb = sizes_kb[idx] = size / 1024
+        log.debug("📦 Quality %d: %d KB", quality, size_kb)
+        fits = size_kb <= target_kb
+        if fits and (best_fit is None or idx > best_fit[0]):
+            best_fit = (idx, jpegs)
+        return fits
+
+    def next_probe(lo: int, hi: int, interpolate: bool) -> int:
+        # Interpolate between the two bracketing sizes, alternating with plain bisection so a
+        # badly-curved size/quality relation can't make the search degrade to a linear scan.
+        if not interpolate or lo < 0 or sizes_kb[hi] <= sizes_kb[lo]:
+            return (lo + hi) // 2
+        frac = (target_kb - sizes_kb[lo]) / (sizes_kb[hi] - sizes_kb[lo])
+        return min(hi - 1, max(lo + 1, lo + int(frac * (hi - lo))))
+
+    # Invariant: index `lo` fits the target (-1 = none known yet), index `hi` doesn't.
+    lo, hi = -1, len(COMPRESS_QUALITIES) - 1
+    if probe(hi):
+        lo = hi
+    else:
+        # Seed: assume size is proportional to quality, from the first (highest quality) encode.
+        estimate = COMPRESS_QUALITIES[hi] * target_kb / sizes_kb[hi]
+        seed = max(0, min(hi - 1, int((estimate - COMPRESS_QUALITIES[0]) // 5)))
+        if probe(seed):
+            lo = seed
+        else:
+            hi = seed
+        step = 0
+        while hi - lo > 1:
+            idx = next_probe(lo, hi, interpolate=step % 2 == 0)
+            if probe(idx):
+                lo = idx
+            else:
+                hi = idx
+            step += 1
+
+    output = None
+    if best_fit is not None:
+        idx, jpegs = best_fit
+        output = built[1] if built is not None and built[0] == idx else _jpeg_pages_pdf(pages, jpegs)
+    stats = {
+        "attempts": len(sizes_kb),
+        "search_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    if best_fit is not None:
+        return output, COMPRESS_QUALITIES[best_fit[0]], len(output) / 1024, stats
+
+    # Nothing fit: the lowest quality was probed (hi reached 0) and is the smallest we can do
+    return None, COMPRESS_QUALITIES[0], sizes_kb[0], stats
+
+
+# mode=structural: keep text/vectors, only recompress images sharper than the threshold
+STRUCTURAL_DPI_THRESHOLD = int(os.getenv("STRUCTURAL_DPI_THRESHOLD", "150"))
+STRUCTURAL_DPI_TARGET = int(os.getenv("STRUCTURAL_DPI_TARGET", "100"))
+STRUCTURAL_JPEG_QUALITY = int(os.getenv("STRUCTURAL_JPEG_QUALITY", "60"))
+
+# duplicate objects merged, unused ones dropped and every stream deflated
+STRUCTURAL_SAVE_OPTIONS = {
+    "garbage": 4,
+    "clean": True,
+    "deflate": True,
+    "deflate_images": True,
+    "deflate_fonts": True,
+    "use_objstms": 1,
+}
+
+
+def _structural_compress_doc(doc: fitz.Document, dpi_threshold: int, dpi_target: int, quality: int) -> None:
+    """
+    Compresses without rasterising: embedded images above dpi_threshold are downsampled to
+    dpi_target and re-encoded and fonts are subset. Save with STRUCTURAL_SAVE_OPTIONS.
+    """
+    doc.rewrite_images(dpi_threshold=dpi_threshold, dpi_target=dpi_target, quality=quality)
+    doc.subset_fonts()
+
+
+def _structural_compress_pdf_bytes(pdf: bytes, dpi_threshold: int, dpi_target: int, quality: int) -> bytes:
+    with _fitz_lock:
+        doc = fitz.open(stream=pdf, filetype="pdf")
+        try:
+            _structural_compress_doc(doc, dpi_threshold, dpi_target, quality)
+            return doc.tobytes(**STRUCTURAL_SAVE_OPTIONS)
+        finally:
+            doc.close()
+
+
+def _compress_params(
+    target_kb: float | str, mode: str | None, dpi_threshold: int | str | None, dpi_target: int | str | None,
+    quality: int | str | None,
+) -> dict:
+    """Validates the options (numbers may still be strings) and fills in the structural-mode defaults."""
+    mode = (mode or "raster").lower()
+    if mode not in ("raster", "structural"):
+        raise HTTPException(status_code=400, detail="mode must be 'raster' or 'structural'.")
+    target_kb = _number_param(target_kb, "target_kb", float)
+    if not target_kb > 0:
+        raise HTTPException(status_code=400, detail="target_kb must be > 0.")
+
+    params = {"mode": mode, "target_kb": target_kb}
+    if mode == "structural":
+        dpi_threshold = STRUCTURAL_DPI_THRESHOLD if dpi_threshold is None else _number_param(dpi_threshold, "dpi_threshold")
+        if dpi_target is None:
+            dpi_target = min(STRUCTURAL_DPI_TARGET, dpi_threshold - 1)
+        dpi_target = _number_param(dpi_target, "dpi_target")
+        quality = STRUCTURAL_JPEG_QUALITY if quality is None else _number_param(quality, "quality")
+        if not 0 < dpi_target < dpi_threshold:
+            raise HTTPException(status_code=400, detail="dpi_target must be > 0 and below dpi_threshold.")
+        if not 1 <= quality <= 100:
+            raise HTTPException(status_code=400, detail="quality must be between 1 and 100.")
+        params.update(dpi_threshold=dpi_threshold, dpi_target=dpi_target, quality=quality)
+    return params
+
+
+async def _compress_pdf(request: Request, pdf, params: dict) -> Response:
+    key, cached = await cached_result(request, "compress-pdf", [pdf], params)
+    if cached is not None:
+        return cached
+
+    target_kb = params["target_kb"]
+    structural_kb = None
+    if params["mode"] == "structural":
+        with stage("compress-pdf", "encode"):
+            structural = await run_in_thread(
+                "compress-pdf",
+                _structural_compress_pdf_bytes,
+                pdf,
+                params["dpi_threshold"],
+                params["dpi_target"],
+                params["quality"],
+            )
+        record_bytes("compress-pdf", "encode", len(structural))
+        structural_kb = len(structural) / 1024
+        log.debug("📦 Structural: %d KB", structural_kb)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+        if structural_kb <= target_kb:
+            return await cache_result(key, StreamingResponse(io.BytesIO(structural), media_type="application/pdf", headers={
+                "Content-Disposition": "inline; filename=compressed_structural.pdf",
+                "X-Compress-Mode": "structural",
+            }))
+        # Target not reachable while keeping the structure: fall back to rasterising
 
-HTML = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0">
-  <title>FileWay Backend</title>
-  <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;700&display=swap" rel="stylesheet">
-  <style>
-    body {
-      margin: 0;
-      padding: 0;
-      min-height: 100vh;
-      display: flex;
-      align-items: center;
-      justify-content: center;
-      background: #121212;
-      font-family: 'Inter', Arial, sans-serif;
-    }
-    .container {
-      background: #000;
-      border-radius: 18px;
-      box-shadow: 0 8px 32px rgba(20, 20, 40, 0.32);
-      padding: 48px 36px;
-      max-width: 420px;
-      text-align: center;
-    }
-    h1 {
-      font-size: 2.2rem;
-      font-weight: 700;
-      margin-bottom: 18px;
-      color: #74a1af;
-      letter-spacing: -1px;
-      line-height: 1.1;
-    }
-    .fileway {
-      font-size: 3.6rem;
-      font-weight: 800;
-      color: #943900;
-      letter-spacing: -2px;
-      display: inline-block;
-      margin: 10px 0 4px 0;
-    }
-    .backend {
-      color: #b8b8b8;
-    }
-    p {
-      font-size: 1.1rem;
-      color: #b8b8b8;
-      margin: 16px 0;
-    }
-    a {
-      color: #ff9800;
-      text-decoration: none;
-      font-weight: 600;
-      transition: color 0.2s;
-    }
-    a:hover {
-      color: #7a3306;
-      text-decoration: underline;
-    }
-    .status {
-      display: inline-block;
-      background: #1a1a1a;
-      color: #943900;
-      font-weight: 600;
-      border-radius: 8px;
-      padding: 4px 12px;
-      margin-bottom: 8px;
-      font-size: 1rem;
-      box-shadow: 0 2px 8px rgba(122,51,6,0.10);
-    }
-    .tagline {
-      font-size: 1.08rem;
-      color: #ffb26b;
-      font-weight: 500;
-      margin: 18px 0 0 0;
-      letter-spacing: 0.01em;
-      background: #1a1a1a;
-      border-radius: 8px;
-      padding: 10px 0 10px 0;
-      box-shadow: 0 2px 8px rgba(122,51,6,0.10);
-      text-align: center;
-      transition: background 0.2s;
+    doc_key = await run_in_thread(None, content_key, pdf)
+    page_count, width, height = await run_in_thread(None, _doc_info, doc_key, pdf)
+    _check_raster_budget(page_count, width, height)
+
+    started = time.perf_counter()
+    async with aclosing(render_pages("compress-pdf", pdf, _page_rgb, COMPRESS_DPI, key=doc_key)) as rendered:
+        rgb_pages = [page async for page in rendered]
+    render_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    with stage("compress-pdf", "encode"):
+        compressed, best_quality, best_size_kb, stats = await run_in_thread(
+            "compress-pdf", _compress_pdf_bytes, rgb_pages, target_kb
+        )
+    ENCODE_ATTEMPTS.observe(stats["attempts"], "compress-pdf")
+    stats["render_ms"] = render_ms
+
+    if compressed is not None:
+        return await cache_result(key, StreamingResponse(io.BytesIO(compressed), media_type="application/pdf", headers={
+            "Content-Disposition": f"inline; filename=compressed_q{best_quality}.pdf",
+            "X-Compress-Mode": "raster",
+            "X-Compress-Attempts": str(stats["attempts"]),
+            "X-Compress-Render-Ms": str(stats["render_ms"]),
+            "X-Compress-Search-Ms": str(stats["search_ms"]),
+        }))
+
+    # If target was not met, return info about min possible
+    result = {
+        "message": "❌ Cannot compress to desired size.",
+        "min_possible_kb": round(best_size_kb, 2),
+        "best_quality": best_quality,
+        **stats,
     }
-    .tagline .emoji {
-      font-size: 1.2em;
-      margin-left: 4px;
+    if structural_kb is not None:
+        result["structural_kb"] = round(structural_kb, 2)
+        result["min_possible_kb"] = round(min(best_size_kb, structural_kb), 2)
+    return await cache_result(key, JSONResponse(result, status_code=200))
+
+
+@app.post("/compress-pdf")
+@route_errors()
+async def compress_pdf(request: Request):
+    data = await request.json()
+    pdf_url = data.get("pdf_urls")
+    params = _compress_params(
+        data.get("target_kb", 500),
+        data.get("mode"),
+        data.get("dpi_threshold"),
+        data.get("dpi_target"),
+        data.get("quality"),
+    )
+
+    if isinstance(pdf_url, list):
+        pdf_url = pdf_url[0]
+
+    response = await fetch(pdf_url, "compress-pdf", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
+
+    return await _compress_pdf(request, response.content, params)
+
+
+@uploads.post("/compress-pdf/upload")
+@route_errors()
+async def compress_pdf_upload(
+    request: Request,
+    file: UploadFile = File(...),
+    target_kb: float | str = Form(500),
+    mode: str = Form("raster"),
+    dpi_threshold: int | str | None = Form(None),
+    dpi_target: int | str | None = Form(None),
+    quality: int | str | None = Form(None),
+):
+    params = _compress_params(target_kb, mode, dpi_threshold, dpi_target, quality)
+    return await _compress_pdf(request, upload_source(file), params)
+
+
+def _encrypt_pdf_fitz(pdf, params: dict) -> bytes:
+    with fitz.open(stream=pdf, filetype="pdf") as doc:
+        if doc.needs_pass:
+            raise HTTPException(status_code=400, detail="PDF is already password protected.")
+        return doc.tobytes(**_fitz_encryption(params))
+
+
+def _encrypt_pdf_bytes(pdf: bytes, params: dict) -> bytes:
+    from PyPDF2 import PdfReader, PdfWriter
+
+    reader = PdfReader(io.BytesIO(pdf))
+    writer = PdfWriter()
+
+    for page in reader.pages:
+        writer.add_page(page)
+
+    # Set encryption
+    writer.encrypt(
+        user_password=params["password"],
+        owner_password=params["owner_password"],
+        permissions_flag=params["permissions"] | PDF_PERMISSION_RESERVED_BITS,
+    )
+
+    output_stream = io.BytesIO()
+    writer.write(output_stream)
+    return output_stream.getvalue()
+
+
+async def _encrypt_pdf(pdf, params: dict, engine: str) -> Response:
+    with stage("encrypt-pdf", "encode"):  # parse + write both happen in one call
+        if engine == "pymupdf":
+            protected = await run_in_thread("encrypt-pdf", _with_fitz, _encrypt_pdf_fitz, pdf, params)
+        else:
+            protected = await run_in_process("encrypt-pdf", _encrypt_pdf_bytes, pdf, params)
+    record_bytes("encrypt-pdf", "encode", len(protected))
+
+    return Response(protected, media_type="application/pdf", headers={
+        "Content-Disposition": "inline; filename=protected.pdf"
+    })
+
+
+@app.post("/encrypt-pdf")
+@route_errors()
+async def encrypt_pdf(request: Request):
+    data = await request.json()
+    pdf_url = data.get("pdf_urls")
+    password = data.get("password")
+
+    if not pdf_url or not password:
+        raise HTTPException(status_code=400, detail="Missing PDF URL or password.")
+    params = _encrypt_params(password, data.get("owner_password"), data.get("permissions"))
+    engine = _pdf_engine(data.get("engine"), CRYPT_ENGINE)
+
+    # Handle case where URL is a list
+    if isinstance(pdf_url, list):
+        pdf_url = pdf_url[0]
+
+    response = await fetch(pdf_url, "encrypt-pdf", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
+
+    return await _encrypt_pdf(response.content, params, engine)
+
+
+@uploads.post("/encrypt-pdf/upload")
+@route_errors()
+async def encrypt_pdf_upload(
+    file: UploadFile = File(...),
+    password: str = Form(...),
+    owner_password: str | None = Form(None),
+    permissions: str | None = Form(None),
+    engine: str | None = Form(None),
+):
+    params = _encrypt_params(password, owner_password, permissions)
+    return await _encrypt_pdf(upload_source(file), params, _pdf_engine(engine, CRYPT_ENGINE))
+
+
+###==================================================================###
+# PDF pipeline: chains unlock / split / merge / compress / dark_mode / encrypt on one
+# in-memory fitz document, so a flow like unlock -> split -> compress downloads and parses
+# the PDF once and serialises only the final result. Every step holds _fitz_lock only for
+# its own work (raster steps per chunk of pages), so other requests interleave with it.
+
+PIPELINE_STEPS = ("unlock", "split", "merge", "compress", "dark_mode", "encrypt")
+
+
+def _pipeline_steps(steps, source_count: int) -> list[dict]:
+    """Validates the steps up front (before anything is downloaded) and fills in defaults."""
+    if not isinstance(steps, list) or not steps:
+        raise HTTPException(status_code=400, detail="steps must be a non-empty list.")
+
+    def step_number(step: dict, i: int, name: str, default=None, kind=int):
+        """step[name] (else `default`) as a number, or None when unset; a 400 naming steps[i].name otherwise."""
+        value = step.get(name, default)
+        return None if value is None else _number_param(value, f"steps[{i}].{name}", kind)
+
+    validated = []
+    for i, step in enumerate(steps):
+        if not isinstance(step, dict) or step.get("op") not in PIPELINE_STEPS:
+            raise HTTPException(status_code=400, detail=f"steps[{i}].op must be one of: {', '.join(PIPELINE_STEPS)}.")
+        op = step["op"]
+        if op in ("unlock", "encrypt"):
+            if not step.get("password"):
+                raise HTTPException(status_code=400, detail=f"steps[{i}] ({op}) needs a password.")
+            if op == "encrypt":
+                params = _encrypt_params(step["password"], step.get("owner_password"), step.get("permissions"))
+            else:
+                params = {"password": str(step["password"])}
+        elif op == "split":
+            if step.get("start") is None or step.get("end") is None:
+                raise HTTPException(status_code=400, detail=f"steps[{i}] (split) needs start and end.")
+            params = {"start": step_number(step, i, "start"), "end": step_number(step, i, "end")}
+        elif op == "compress":
+            params = _compress_params(
+                step_number(step, i, "target_kb", 500, float),
+                step.get("mode"),
+                step_number(step, i, "dpi_threshold"),
+                step_number(step, i, "dpi_target"),
+                step_number(step, i, "quality"),
+            )
+        elif op == "dark_mode":
+            params = _dark_mode_params(
+                step.get("mode"),
+                step_number(step, i, "dpi", DARK_MODE_DPI),
+                step.get("image_format"),
+                step_number(step, i, "quality", DARK_MODE_JPEG_QUALITY),
+            )
+        else:
+            params = {}
+        validated.append({"op": op, **params})
+
+    ops = [step["op"] for step in validated]
+    if "encrypt" in ops[:-1]:
+        raise HTTPException(status_code=400, detail="encrypt must be the last step.")
+    if ops.count("merge") != (1 if source_count > 1 else 0):
+        raise HTTPException(status_code=400, detail="Use exactly one merge step when (and only when) there are several PDFs.")
+    return validated
+
+
+def _with_fitz(fn, *args):
+    with _fitz_lock:
+        return fn(*args)
+
+
+def _pipeline_unlock(doc: fitz.Document, password: str) -> None:
+    if not _has_encryption(doc):
+        raise HTTPException(status_code=400, detail="PDF is not encrypted.")
+    if not doc.authenticate(password):
+        raise HTTPException(status_code=401, detail="Incorrect password.")
+
+
+def _pipeline_split(doc: fitz.Document, start: int, end: int) -> None:
+    if start < 1 or end > doc.page_count or start > end:
+        raise HTTPException(status_code=400, detail="Invalid page range.")
+    doc.select(range(start - 1, end))
+
+
+def _pipeline_merge(doc: fitz.Document, pdfs: list) -> None:
+    for pdf in pdfs:
+        with fitz.open(stream=pdf, filetype="pdf") as src:
+            if src.needs_pass:
+                raise HTTPException(status_code=400, detail="Merged PDFs must not be password protected.")
+            doc.insert_pdf(src)
+
+
+def _pipeline_render_chunk(doc: fitz.Document, page_nums: range, renderer, dpi: int) -> list:
+    # the pipeline's document is modified in place, so its pages never go through the render cache
+    return [renderer(_render_pixmap(doc[page_num], dpi), dpi) for page_num in page_nums]
+
+
+async def _pipeline_render(doc: fitz.Document, renderer, dpi: int) -> list:
+    """Renders every page of the in-memory document, RENDER_CHUNK_PAGES pages per lock hold."""
+    page_count = await run_in_thread(None, _with_fitz, lambda: doc.page_count)
+    PAGES.inc("pdf-pipeline", amount=page_count)
+    pages = []
+    with stage("pdf-pipeline", "render"):
+        for start in range(0, page_count, RENDER_CHUNK_PAGES):
+            chunk = range(start, min(start + RENDER_CHUNK_PAGES, page_count))
+            pages += await run_in_thread(None, _with_fitz, _pipeline_render_chunk, doc, chunk, renderer, dpi)
+    return pages
+
+
+def _pipeline_save(doc: fitz.Document, options: dict) -> bytes:
+    return doc.tobytes(**options)
+
+
+async def _run_pipeline(sources: list, steps: list[dict]) -> tuple[bytes | None, dict | None]:
+    """
+    Runs `steps` on the first source (merge appends the rest). Returns (pdf, None), or
+    (None, info) when a compress step can't reach its target, like /compress-pdf does.
+    """
+    save_options = {"garbage": 3, "deflate": True}
+    output = None
+    with stage("pdf-pipeline", "parse"):
+        doc = await run_in_thread(None, _with_fitz, lambda: fitz.open(stream=sources[0], filetype="pdf"))
+    try:
+        for i, step in enumerate(steps):
+            op = step["op"]
+            # is_encrypted is cleared by authenticate(); needs_pass isn't, and reading it re-runs the
+            # password check, which drops the key and leaves the saved streams undecrypted
+            if op != "unlock" and await run_in_thread(None, _with_fitz, lambda: doc.is_encrypted and doc.needs_pass):
+                raise HTTPException(status_code=400, detail="PDF is password protected, add an unlock step first.")
+
+            if op == "unlock":
+                await run_in_thread(None, _with_fitz, _pipeline_unlock, doc, step["password"])
+            elif op == "split":
+                await run_in_thread(None, _with_fitz, _pipeline_split, doc, step["start"], step["end"])
+            elif op == "merge":
+                await run_in_thread(None, _with_fitz, _pipeline_merge, doc, sources[1:])
+            elif op == "encrypt":
+                # AES-256, like /encrypt-pdf's pymupdf engine
+                save_options.update(_fitz_encryption(step))
+            elif op == "dark_mode" and step["mode"] == "vector":
+                await run_in_thread(None, _with_fitz, _vector_dark_mode_doc, doc)
+            elif op == "dark_mode":
+                renderer = functools.partial(
+                    _page_dark_pdf,
+                    image_format=step["image_format"],
+                    quality=step.get("quality", DARK_MODE_JPEG_QUALITY),
+                )
+                pages = await _pipeline_render(doc, renderer, step["dpi"])
+                dark = await run_in_thread(None, _with_fitz, _join_page_docs, pages)
+                await run_in_thread(None, _with_fitz, doc.close)
+                doc = dark
+            else:  # compress
+                if step["mode"] == "structural":
+                    await run_in_thread(
+                        None, _with_fitz, _structural_compress_doc,
+                        doc, step["dpi_threshold"], step["dpi_target"], step["quality"],
+                    )
+                    # Measured on the save the pipeline would make from here (too big still falls
+                    # back to raster); as the last step, that save is the output
+                    options = {**save_options, **STRUCTURAL_SAVE_OPTIONS}
+                    structural = await run_in_thread(None, _with_fitz, _pipeline_save, doc, options)
+                    if len(structural) / 1024 <= step["target_kb"]:
+                        save_options = options
+                        if i == len(steps) - 1:
+                            output = structural
+                        continue
+
+                page_count, width, height = await run_in_thread(
+                    None, _with_fitz, lambda: (doc.page_count, doc[0].rect.width, doc[0].rect.height)
+                )
+                _check_raster_budget(page_count, width, height)
+                rgb_pages = await _pipeline_render(doc, _page_rgb, COMPRESS_DPI)
+                with stage("pdf-pipeline", "encode"):
+                    compressed, best_quality, best_size_kb, stats = await run_in_thread(
+                        None, _compress_pdf_bytes, rgb_pages, step["target_kb"]
+                    )
+                ENCODE_ATTEMPTS.observe(stats["attempts"], "pdf-pipeline")
+                if compressed is None:
+                    return None, {
+                        "message": "❌ Cannot compress to desired size.",
+                        "step": i,
+                        "min_possible_kb": round(best_size_kb, 2),
+                        "best_quality": best_quality,
+                        **stats,
+                    }
+                await run_in_thread(None, _with_fitz, doc.close)
+                doc = await run_in_thread(None, _with_fitz, lambda: fitz.open(stream=compressed, filetype="pdf"))
+
+        if output is None:
+            with stage("pdf-pipeline", "encode"):
+                output = await run_in_thread(None, _with_fitz, _pipeline_save, doc, save_options)
+        record_bytes("pdf-pipeline", "encode", len(output))
+        return output, None
+    finally:
+        await run_in_thread(None, _with_fitz, doc.close)
+
+
+async def _pdf_pipeline(request: Request, pdfs: list, steps: list[dict]) -> Response:
+    key = None
+    # like /unlock-pdf and /encrypt-pdf, output that depends on a password is never cached
+    if not any("password" in step for step in steps):
+        key, cached = await cached_result(request, "pdf-pipeline", pdfs, {"steps": steps})
+        if cached is not None:
+            return cached
+
+    async with _endpoint_slot("pdf-pipeline"):
+        output, info = await _run_pipeline(pdfs, steps)
+    if output is None:
+        return await cache_result(key, JSONResponse(info, status_code=200))
+
+    return await cache_result(key, StreamingResponse(io.BytesIO(output), media_type="application/pdf", headers={
+        "Content-Disposition": "inline; filename=pipeline.pdf"
+    }))
+
+
+@app.post("/pdf-pipeline")
+@route_errors("Error running PDF pipeline")
+async def pdf_pipeline(request: Request):
+    """
+    {"pdf_urls": [...], "steps": [{"op": "unlock", "password": ...}, {"op": "split", "start": 1,
+    "end": 3}, {"op": "compress", "target_kb": 300}, ...]}. Step options are the ones the
+    matching endpoint takes; merge appends pdf_urls[1:] to the first PDF.
+    """
+    data = await request.json()
+    pdf_urls = data.get("pdf_urls")
+    if not pdf_urls:
+        raise HTTPException(status_code=400, detail="No PDF URLs provided.")
+    if not isinstance(pdf_urls, list):
+        pdf_urls = [pdf_urls]
+
+    steps = _pipeline_steps(data.get("steps"), len(pdf_urls))
+
+    responses = await fetch_all(pdf_urls, "pdf-pipeline", "pdf")
+    if any(response.status_code != 200 for response in responses):
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
+
+    return await _pdf_pipeline(request, [response.content for response in responses], steps)
+
+
+@uploads.post("/pdf-pipeline/upload")
+@route_errors("Error running PDF pipeline")
+async def pdf_pipeline_upload(request: Request, files: list[UploadFile] = File(...), steps: str = Form(...)):
+    """Same as /pdf-pipeline, with the steps list sent as a JSON string form field."""
+    try:
+        steps = json.loads(steps)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="steps must be a JSON list.")
+    validated = _pipeline_steps(steps, len(files))
+    return await _pdf_pipeline(request, upload_sources(files), validated)
+
+
+async def _pdf_to_images(request: Request, pdf) -> Response:
+    key, cached = await cached_result(request, "pdf-to-images", [pdf], {"dpi": 150})
+    if cached is not None:
+        return cached
+
+    doc_key = await run_in_thread(None, content_key, pdf)
+    num_pages = await run_in_thread("pdf-to-images", _count_pages, doc_key, pdf)
+
+    # If only 1 page, return single JPG file
+    if num_pages == 1:
+        async with aclosing(render_pages("pdf-to-images", pdf, _page_jpeg, 150, key=doc_key)) as rendered:
+            jpeg = [page async for page in rendered][0]
+
+        return await cache_result(key, StreamingResponse(io.BytesIO(jpeg), media_type="image/jpeg", headers={
+            "Content-Disposition": "inline; filename=page_1.jpg"
+        }))
+
+    # If multiple pages, render them in parallel and stream a zip file in page order
+    async def pages():
+        async with aclosing(render_pages("pdf-to-images", pdf, _page_jpeg, 150, key=doc_key)) as rendered:
+            page_num = 0
+            async for jpeg in rendered:
+                page_num += 1
+                yield f"page_{page_num}.jpg", jpeg
+
+    return await cache_result(key, await zip_streaming_response("pdf-to-images", pages(), "pdf_images.zip"))
+
+@app.post("/pdf-to-images")
+@route_errors("Error converting PDF to images")
+async def pdf_to_images(request: Request):
+    data = await request.json()
+    pdf_url = data.get("pdf_urls")
+
+    if not pdf_url:
+        raise HTTPException(status_code=400, detail="Missing PDF URL.")
+
+    if isinstance(pdf_url, list):
+        pdf_url = pdf_url[0]
+
+    response = await fetch(pdf_url, "pdf-to-images", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
+
+    return await _pdf_to_images(request, response.content)
+
+
+@uploads.post("/pdf-to-images/upload")
+@route_errors("Error converting PDF to images")
+async def pdf_to_images_upload(request: Request, file: UploadFile = File(...)):
+    return await _pdf_to_images(request, upload_source(file))
+
+###==================================================================###
+# Text extraction: the pdf-to-word / excel / powerpoint / text / ndjson writers all read the
+# same structured page text (blocks > lines > spans, plus tables on request). Pages are
+# extracted from the cached document a chunk at a time on the thread pool, the next chunk
+# already extracting while the writer consumes this one, and are kept per
+# (content hash, page) in an LRU bounded by TEXT_CACHE_BYTES.
+
+TEXT_CACHE_BYTES = int(os.getenv("TEXT_CACHE_BYTES", str(128 * 1024 * 1024)))  # 0 disables
+TEXT_CHUNK_PAGES = int(os.getenv("TEXT_CHUNK_PAGES", "16"))
+
+
+def _bbox(rect) -> list[float]:
+    return [round(v, 2) for v in rect]
+
+
+def _extract_page(page: fitz.Page) -> dict:
+    """
+    One page as {page, width, height, text, blocks}. `text` is exactly what page.get_text()
+    returns (the spans of each line, one line per row), so the writers' output is unchanged.
+    """
+    blocks = []
+    text = []
+    for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)["blocks"]:  # type: ignore
+        lines = []
+        for line in block["lines"]:
+            spans = [
+                {
+                    "text": span["text"],
+                    "bbox": _bbox(span["bbox"]),
+                    "font": span["font"],
+                    "size": round(span["size"], 2),
+                    "flags": span["flags"],
+                    "color": span["color"],
+                }
+                for span in line["spans"]
+            ]
+            lines.append({"bbox": _bbox(line["bbox"]), "spans": spans})
+            text.append("".join(span["text"] for span in spans))
+            text.append("\n")
+        blocks.append({"bbox": _bbox(block["bbox"]), "lines": lines})
+
+    return {
+        "page": page.number + 1,  # type: ignore
+        "width": round(page.rect.width, 2),
+        "height": round(page.rect.height, 2),
+        "text": "".join(text),
+        "blocks": blocks,
     }
-  </style>
-</head>
-<body>
-  <div class="container">
-    <h1>
-      Welcome to <br>
-      <span class="fileway">FileWay</span><br>
-      backend
-    </h1>
-    <div class="status">Backend is running ✅</div>
-    <p>Go to <a href="https://fileway.vercel.app/" target="_blank">Frontend</a></p>
-    <div class="tagline">One-stop solution for all your file types <span class="emoji">⚡🛠️✨</span></div>
-  </div>
-</body>
-</html>
-"""
 
 
+def _extract_tables(page: fitz.Page) -> list[dict]:
+    # several times the cost of the text itself, so only done for writers that ask
+    return [{"bbox": _bbox(table.bbox), "rows": table.extract()} for table in page.find_tables().tables]  # type: ignore
+
+
+def _page_text_size(page: dict) -> int:
+    # rough Python footprint: the strings plus ~800 bytes of dicts / lists / floats per span
+    spans = sum(len(line["spans"]) for block in page["blocks"] for line in block["lines"])
+    cells = sum(len(row) for table in page.get("tables", ()) for row in table["rows"])
+    return 2 * len(page["text"]) + 800 * spans + 100 * cells + 500
+
+
+_text_cache = LRUCache(TEXT_CACHE_BYTES, _page_text_size) if TEXT_CACHE_BYTES > 0 else None
+
+
+def _extract_chunk(key: str, pdf, page_nums: list[int], tables: bool) -> list[dict]:
+    """Cached pages as they are; the rest are extracted from the shared document and cached."""
+    pages = [_text_cache.get((key, page_num)) if _text_cache is not None else None for page_num in page_nums]
+    if all(page is not None and (not tables or "tables" in page) for page in pages):
+        return pages
+
+    with _fitz_lock, _doc_cache.open(key, pdf) as doc:
+        for i, page_num in enumerate(page_nums):
+            page = pages[i]
+            if page is not None and (not tables or "tables" in page):
+                continue
+            fitz_page = doc[page_num]
+            if page is None:
+                page = _extract_page(fitz_page)
+            if tables and "tables" not in page:
+                # cached pages are shared, so the one with tables is a new dict
+                page = {**page, "tables": _extract_tables(fitz_page)}
+            pages[i] = page
+            if _text_cache is not None:
+                _text_cache.put((key, page_num), page)
+    return pages
+
+
+async def extract_pages(
+    endpoint: str, pdf, *, key: str | None = None, tables: bool = False, start: int = 0, end: int | None = None
+):
+    """
+    Yields the extracted text of pages [start, end) (see _extract_page; with "tables" when
+    asked) in page order. The dicts may be shared with the cache and must not be modified.
+    """
+    if key is None:
+        key = await run_in_thread(None, content_key, pdf)
+    page_count = await run_in_thread(None, _count_pages, key, pdf)
+    end = page_count if end is None else min(end, page_count)
+    PAGES.inc(endpoint, amount=max(0, end - start))
+    chunks = [list(range(first, min(first + TEXT_CHUNK_PAGES, end))) for first in range(start, end, TEXT_CHUNK_PAGES)]
+
+    loop = asyncio.get_running_loop()
+    pending: collections.deque = collections.deque()
+    next_chunk = 0
+    waited = 0.0
+    try:
+        while next_chunk < len(chunks) or pending:
+            # extraction holds _fitz_lock, so one chunk of read-ahead is all that helps
+            while next_chunk < len(chunks) and len(pending) < 2:
+                pending.append(loop.create_task(run_in_thread(endpoint, _extract_chunk, key, pdf, chunks[next_chunk], tables)))
+                next_chunk += 1
+            started = time.perf_counter()
+            pages = await pending.popleft()
+            waited += time.perf_counter() - started
+            for page in pages:
+                if not tables and "tables" in page:
+                    # cached by an earlier request that asked for tables; output must not depend on that
+                    page = {name: value for name, value in page.items() if name != "tables"}
+                yield page
+    finally:
+        for task in pending:
+            task.cancel()
+        STAGE_SECONDS.observe(waited, endpoint, "parse")
+
+
+async def _pdf_to_word(request: Request, pdf) -> Response:
+    key, cached = await cached_result(request, "pdf-to-word", [pdf], {})
+    if cached is not None:
+        return cached
+
+    from docx import Document
+
+    doc_key = await run_in_thread(None, content_key, pdf)
+    page_count = await run_in_thread(None, _count_pages, doc_key, pdf)
+    word_doc = Document()
+
+    async with aclosing(extract_pages("pdf-to-word", pdf, key=doc_key)) as pages:
+        async for page in pages:
+            if page["text"].strip():
+                word_doc.add_paragraph(page["text"])
+                if page["page"] < page_count:
+                    word_doc.add_page_break()
+
+    output_buffer = io.BytesIO()
+    with stage("pdf-to-word", "encode"):
+        await run_in_thread("pdf-to-word", word_doc.save, output_buffer)
+    record_bytes("pdf-to-word", "encode", output_buffer.tell())
+    output_buffer.seek(0)
+
+    return await cache_result(key, StreamingResponse(output_buffer, media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document", headers={
+        "Content-Disposition": "attachment; filename=converted.docx"
+    }))
+
+
+@app.post("/pdf-to-word")
+@route_errors("Error converting PDF to Word")
+async def pdf_to_word(request: Request):
+    data = await request.json()
+    pdf_url = data.get("pdf_urls")
+
+    if not pdf_url:
+        raise HTTPException(status_code=400, detail="Missing PDF URL.")
+
+    if isinstance(pdf_url, list):
+        pdf_url = pdf_url[0]
+
+    response = await fetch(pdf_url, "pdf-to-word", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
+
+    return await _pdf_to_word(request, response.content)
+
+
+@uploads.post("/pdf-to-word/upload")
+@route_errors("Error converting PDF to Word")
+async def pdf_to_word_upload(request: Request, file: UploadFile = File(...)):
+    return await _pdf_to_word(request, upload_source(file))
+
+
+def _append_excel_page(wb, ws, page: dict) -> None:
+    """Adds one page's text lines (and a sheet per table, if extracted) to a write-only workbook."""
+    text = page["text"]
+    if text.strip():
+        for line in text.split('\n'):
+            if line.strip():
+                ws.append([line.strip()])
+
+        ws.append([f"--- Page {page['page']} ---"])
+
+    for number, table in enumerate(page.get("tables", ()), start=1):
+        table_ws = wb.create_sheet(f"Page {page['page']} Table {number}")
+        for row in table["rows"]:
+            table_ws.append(row)
 
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    return HTML
+async def _pdf_to_excel(request: Request, pdf, tables: bool) -> Response:
+    key, cached = await cached_result(request, "pdf-to-excel", [pdf], {"tables": tables})
+    if cached is not None:
+        return cached
 
+    from openpyxl import Workbook
 
-@app.get("/ping")
-async def ping():
-    return {"status": "ok"}
+    # Write-only: appended rows go straight to a temp file per sheet instead of being kept
+    # as cell objects, so memory stays flat however many pages there are.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("PDF Content")
 
+    async with aclosing(extract_pages("pdf-to-excel", pdf, tables=tables)) as pages:
+        async for page in pages:
+            await run_in_thread("pdf-to-excel", _append_excel_page, wb, ws, page)
 
-@app.post("/merge-pdfs")
-async def merge_pdfs(request: Request):
-    try:
-        body = await request.json()
-        pdf_urls = body.get("pdf_urls", [])
+    output_buffer = io.BytesIO()
+    with stage("pdf-to-excel", "encode"):
+        await run_in_thread("pdf-to-excel", wb.save, output_buffer)
+    record_bytes("pdf-to-excel", "encode", output_buffer.tell())
+    output_buffer.seek(0)
 
-        if not pdf_urls:
-            raise HTTPException(status_code=400, detail="No PDF URLs provided.")
+    return await cache_result(key, StreamingResponse(output_buffer, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={
+        "Content-Disposition": "attachment; filename=converted.xlsx"
+    }))
 
-        merger = PdfMerger()
 
-        for url in pdf_urls:
-            print(f"Downloading: {url}")
-            response = requests.get(url)
-            if response.status_code == 200:
-                pdf_stream = io.BytesIO(response.content)
-                merger.append(pdf_stream)
-            else:
-                print(f"Failed to download: {url}")
+@app.post("/pdf-to-excel")
+@route_errors("Error converting PDF to Excel")
+async def pdf_to_excel(request: Request):
+    data = await request.json()
+    pdf_url = data.get("pdf_urls")
 
-        output_pdf = io.BytesIO()
-        merger.write(output_pdf)
-        merger.close()
-        output_pdf.seek(0)
+    if not pdf_url:
+        raise HTTPException(status_code=400, detail="Missing PDF URL.")
 
-        return StreamingResponse(output_pdf, media_type="application/pdf", headers={
-            "Content-Disposition": "inline; filename=merged.pdf"
-        })
+    if isinstance(pdf_url, list):
+        pdf_url = pdf_url[0]
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error merging PDFs: {str(e)}")
-    
-@app.post("/unlock-pdf")
-async def unlock_pdf(request: Request):
-    try:
-        body = await request.json()
-        pdf_url = body.get("pdf_urls")
-        password = body.get("password")
-
-        if not pdf_url:
-            raise HTTPException(status_code=400, detail="URL are required.")
-        if  not password:
-            raise HTTPException(status_code=400, detail="password are required.")
-        
-        if isinstance(pdf_url, list):
-         pdf_url = pdf_url[0]
-
-        print(f"Downloading: {pdf_url}")
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF.")
-
-        pdf_stream = io.BytesIO(response.content)
-        reader = PdfReader(pdf_stream)
-
-        if not reader.is_encrypted:
-            raise HTTPException(status_code=400, detail="PDF is not encrypted.")
+    response = await fetch(pdf_url, "pdf-to-excel", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
 
-        if reader.decrypt(password) == 0:
-            raise HTTPException(status_code=401, detail="Incorrect password.")
+    return await _pdf_to_excel(request, response.content, bool(data.get("tables", False)))
 
-        writer = PdfWriter()
-        for page in reader.pages:
-            writer.add_page(page)
 
-        output_pdf = io.BytesIO()
-        writer.write(output_pdf)
-        output_pdf.seek(0)
+@uploads.post("/pdf-to-excel/upload")
+@route_errors("Error converting PDF to Excel")
+async def pdf_to_excel_upload(request: Request, file: UploadFile = File(...), tables: bool = Form(False)):
+    return await _pdf_to_excel(request, upload_source(file), tables)
 
-        return StreamingResponse(output_pdf, media_type="application/pdf", headers={
-            "Content-Disposition": "inline; filename=unlocked.pdf"
-        })
 
-    except Exception as e:
-        traceback.print_exc()  # 👈 This will print the full error in the terminal
-        raise HTTPException(status_code=500, detail=f"Error unlocking PDF: {str(e)}")
-    
-@app.post("/split-pdf")
-async def split_pdf(request: Request):
-    try:
-        body = await request.json()
-        pdf_url = body.get("pdf_urls") # type: ignore
-        start = int(body.get("start"))
-        end = int(body.get("end"))
+async def _pdf_to_powerpoint(request: Request, pdf) -> Response:
+    key, cached = await cached_result(request, "pdf-to-powerpoint", [pdf], {})
+    if cached is not None:
+        return cached
 
-        if not pdf_url:
-            raise HTTPException(status_code=400, detail="Missing url")
-        if start is None or end is None:
-            raise HTTPException(status_code=400, detail="Missing page range.")
-        if isinstance(pdf_url, list):
-         pdf_url = pdf_url[0]  #
-        
-        
+    from pptx import Presentation
+    from pptx.util import Inches
 
-        # Download the PDF
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF.")
+    prs = Presentation()
+    prs.slide_width = Inches(10)
+    prs.slide_height = Inches(7.5)
 
-        pdf_bytes = io.BytesIO(response.content)
-        reader = PdfReader(pdf_bytes)
+    async with aclosing(extract_pages("pdf-to-powerpoint", pdf)) as pages:
+        async for page in pages:
+            text = page["text"]
 
-        if start < 1 or end > len(reader.pages) or start > end:
-            raise HTTPException(status_code=400, detail="Invalid page range.")
+            slide_layout = prs.slide_layouts[1]
+            slide = prs.slides.add_slide(slide_layout)
 
-        writer = PdfWriter()
-        for i in range(start - 1, end):  # PDF page numbers are 0-based
-            writer.add_page(reader.pages[i])
+            title = slide.shapes.title
+            title.text = f"Page {page['page']}"
 
-        output_pdf = io.BytesIO()
-        writer.write(output_pdf)
-        output_pdf.seek(0)
+            content = slide.placeholders[1]
+            tf = content.text_frame
+            tf.text = text[:1000] if len(text) > 1000 else text
 
-        return StreamingResponse(output_pdf, media_type="application/pdf", headers={
-            "Content-Disposition": "inline; filename=split_pages.pdf"
-        })
+            if len(text) > 1000:
+                p = tf.add_paragraph()
+                p.text = "...(content truncated)"
 
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error splitting PDF: {str(e)}")
-    
-@app.post("/dark-mode-pdf")
-async def convert_to_dark_mode(request: Request):
-    try:
-        data = await request.json()
-        pdf_url = data.get("pdf_urls")
-        if not pdf_url:
-            raise HTTPException(status_code=400, detail="Missing PDF URL")
-        if isinstance(pdf_url, list):
-            pdf_url = pdf_url[0]  # ✅ Take the first item
+    output_buffer = io.BytesIO()
+    with stage("pdf-to-powerpoint", "encode"):
+        await run_in_thread("pdf-to-powerpoint", prs.save, output_buffer)
+    record_bytes("pdf-to-powerpoint", "encode", output_buffer.tell())
+    output_buffer.seek(0)
 
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF")
+    return await cache_result(key, StreamingResponse(output_buffer, media_type="application/vnd.openxmlformats-officedocument.presentationml.presentation", headers={
+        "Content-Disposition": "attachment; filename=converted.pptx"
+    }))
 
-        input_pdf_stream = io.BytesIO(response.content)
-        doc = fitz.open(stream=input_pdf_stream, filetype="pdf")
 
-        dark_pdf = fitz.open()
-        for page in doc:
-            pix = page.get_pixmap(dpi=150) # type: ignore
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples) # type: ignore
+@app.post("/pdf-to-powerpoint")
+@route_errors("Error converting PDF to PowerPoint")
+async def pdf_to_powerpoint(request: Request):
+    data = await request.json()
+    pdf_url = data.get("pdf_urls")
 
-            dark_img = ImageOps.invert(img)
+    if not pdf_url:
+        raise HTTPException(status_code=400, detail="Missing PDF URL.")
 
-            img_buffer = io.BytesIO()
-            dark_img.save(img_buffer, format="PNG")
-            img_buffer.seek(0)
+    if isinstance(pdf_url, list):
+        pdf_url = pdf_url[0]
 
-            rect = fitz.Rect(0, 0, pix.width, pix.height)
-            pdf_page = dark_pdf.new_page(width=rect.width, height=rect.height) # type: ignore
-            pdf_page.insert_image(rect, stream=img_buffer.read())
+    response = await fetch(pdf_url, "pdf-to-powerpoint", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
 
-        output_buffer = io.BytesIO()
-        dark_pdf.save(output_buffer)
-        dark_pdf.close()
-        output_buffer.seek(0)
+    return await _pdf_to_powerpoint(request, response.content)
 
-        return StreamingResponse(output_buffer, media_type="application/pdf", headers={
-            "Content-Disposition": "inline; filename=dark_mode.pdf"
-        })
 
-    except Exception as e:
-        print(f"[ERROR] {str(e)}")  # 🧠 Print error in console
-        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
-    
-@app.post("/compress-pdf")
-async def compress_pdf(request: Request):
-    try:
-        data = await request.json()
-        pdf_url = data.get("pdf_urls")
-        target_kb = float(data.get("target_kb", 500))
-
-        if isinstance(pdf_url, list):
-            pdf_url = pdf_url[0]
-
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF.")
-
-        original_pdf = fitz.open(stream=response.content, filetype="pdf")
-
-        best_pdf_bytes = None
-        best_quality = None
-        best_size_kb = None
-
-        for quality in range(80, 5, -5):  # Try different compression qualities
-            compressed_pdf = fitz.open()
-            for page in original_pdf:
-                pix = page.get_pixmap(dpi=100)  # type: ignore # Lower DPI = smaller file
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples) # type: ignore
-                img_io = io.BytesIO()
-                img.save(img_io, format="JPEG", quality=quality)
-                img_io.seek(0)
-
-                rect = fitz.Rect(0, 0, pix.width, pix.height)
-                new_page = compressed_pdf.new_page(width=rect.width, height=rect.height) # type: ignore
-                new_page.insert_image(rect, stream=img_io.read())
-
-            output_stream = io.BytesIO()
-            compressed_pdf.save(output_stream)
-            compressed_pdf.close()
-
-            size_kb = len(output_stream.getvalue()) / 1024
-
-            print(f"📦 Quality {quality}: {int(size_kb)} KB")
-
-            # Store the best compressed result
-            if best_size_kb is None or size_kb < best_size_kb:
-                best_size_kb = size_kb
-                best_pdf_bytes = output_stream.getvalue()
-                best_quality = quality
-
-            if size_kb <= target_kb:
-                output_stream.seek(0)
-                return StreamingResponse(io.BytesIO(best_pdf_bytes), media_type="application/pdf", headers={ # type: ignore
-                    "Content-Disposition": f"inline; filename=compressed_q{quality}.pdf"
-                })
-
-        # If target was not met, return info about min possible
-        return JSONResponse({
-            "message": "❌ Cannot compress to desired size.",
-            "min_possible_kb": round(best_size_kb, 2), # type: ignore
-            "best_quality": best_quality
-        }, status_code=200)
+@uploads.post("/pdf-to-powerpoint/upload")
+@route_errors("Error converting PDF to PowerPoint")
+async def pdf_to_powerpoint_upload(request: Request, file: UploadFile = File(...)):
+    return await _pdf_to_powerpoint(request, upload_source(file))
 
-    except Exception as e:
-        print("❌ Error:", e)
-        raise HTTPException(status_code=500, detail=str(e))
-    
-@app.post("/encrypt-pdf")
-async def encrypt_pdf(request: Request):
-    try:
-        data = await request.json()
-        pdf_url = data.get("pdf_urls")
-        password = data.get("password")
 
-        if not pdf_url or not password:
-            raise HTTPException(status_code=400, detail="Missing PDF URL or password.")
+TEXT_FORMATS = {
+    "text": {"mime": "text/plain", "ext": "txt"},
+    "ndjson": {"mime": "application/x-ndjson", "ext": "ndjson"},
+}
 
-        # Handle case where URL is a list
-        if isinstance(pdf_url, list):
-            pdf_url = pdf_url[0]
 
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF.")
+def _text_params(output_format: str | None, start: int | str | None, end: int | str | None) -> dict:
+    """
+    Validates the options (start / end may still be strings); only the ones that differ from
+    the defaults go in the cache key.
+    """
+    output_format = (output_format or "text").lower()
+    if output_format not in TEXT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be 'text' or 'ndjson'.")
+    start = None if start is None else _number_param(start, "start")
+    end = None if end is None else _number_param(end, "end")
+    if (start is not None and start < 1) or (end is not None and end < (start or 1)):
+        raise HTTPException(status_code=400, detail="Invalid page range.")
 
-        # Read the PDF
-        input_stream = io.BytesIO(response.content)
-        reader = PdfReader(input_stream)
-        writer = PdfWriter()
+    params: dict = {"format": output_format}
+    if start not in (None, 1):
+        params["start"] = start
+    if end is not None:
+        params["end"] = end
+    return params
 
-        for page in reader.pages:
-            writer.add_page(page)
 
-        # Set encryption
-        writer.encrypt(user_password=password)
+def _text_page_chunk(page: dict, output_format: str) -> bytes:
+    if output_format == "ndjson":
+        line = {"page": page["page"], "text": page["text"], "chars": len(page["text"])}
+        return (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")
+    return f"--- Page {page['page']} ---\n\n{page['text']}\n\n".encode("utf-8")
 
-        output_stream = io.BytesIO()
-        writer.write(output_stream)
-        output_stream.seek(0)
 
-        return StreamingResponse(output_stream, media_type="application/pdf", headers={
-            "Content-Disposition": "inline; filename=protected.pdf"
-        })
+async def _pdf_to_text(request: Request, pdf, params: dict) -> Response:
+    key, cached = await cached_result(request, "pdf-to-text", [pdf], params)
+    if cached is not None:
+        return cached
 
-    except Exception as e:
-        print("❌ Error:", e)
-        raise HTTPException(status_code=500, detail=str(e))
+    doc_key = await run_in_thread(None, content_key, pdf)
+    page_count = await run_in_thread(None, _count_pages, doc_key, pdf)
+    start = params.get("start", 1)
+    end = params.get("end", page_count)
+    if start > max(page_count, 1) or end > page_count:
+        raise HTTPException(status_code=400, detail="Invalid page range.")
 
-@app.post("/pdf-to-images")
-async def pdf_to_images(request: Request):
+    # The first page is extracted before the response starts, so an error on it (e.g. an
+    # encrypted PDF) is still a normal HTTP error rather than an empty 200.
+    pages = extract_pages("pdf-to-text", pdf, key=doc_key, start=start - 1, end=end)
     try:
-        data = await request.json()
-        pdf_url = data.get("pdf_urls")
-        
-        if not pdf_url:
-            raise HTTPException(status_code=400, detail="Missing PDF URL.")
-        
-        if isinstance(pdf_url, list):
-            pdf_url = pdf_url[0]
-        
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF.")
-        
-        pdf_stream = io.BytesIO(response.content)
-        doc = fitz.open(stream=pdf_stream, filetype="pdf")
-        
-        num_pages = len(doc)
-        
-        # If only 1 page, return single JPG file
-        if num_pages == 1:
-            page = doc[0]
-            pix = page.get_pixmap(dpi=150)  # type: ignore
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
-            
-            img_buffer = io.BytesIO()
-            img.save(img_buffer, format="JPEG")
-            img_buffer.seek(0)
-            
-            doc.close()
-            
-            return StreamingResponse(img_buffer, media_type="image/jpeg", headers={
-                "Content-Disposition": "inline; filename=page_1.jpg"
-            })
-        
-        # If multiple pages, return zip file
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for page_num in range(num_pages):
-                page = doc[page_num]
-                pix = page.get_pixmap(dpi=150)  # type: ignore
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
-                
-                img_buffer = io.BytesIO()
-                img.save(img_buffer, format="JPEG")
-                img_buffer.seek(0)
-                
-                zip_file.writestr(f"page_{page_num + 1}.jpg", img_buffer.getvalue())
-        
-        doc.close()
-        zip_buffer.seek(0)
-        
-        return StreamingResponse(zip_buffer, media_type="application/zip", headers={
-            "Content-Disposition": "attachment; filename=pdf_images.zip"
-        })
-    
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error converting PDF to images: {str(e)}")
+        first = await pages.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except BaseException:
+        await pages.aclose()
+        raise
 
-@app.post("/pdf-to-word")
-async def pdf_to_word(request: Request):
-    try:
-        data = await request.json()
-        pdf_url = data.get("pdf_urls")
-        
-        if not pdf_url:
-            raise HTTPException(status_code=400, detail="Missing PDF URL.")
-        
-        if isinstance(pdf_url, list):
-            pdf_url = pdf_url[0]
-        
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF.")
-        
-        pdf_stream = io.BytesIO(response.content)
-        doc = fitz.open(stream=pdf_stream, filetype="pdf")
-        
-        from docx import Document
-        
-        word_doc = Document()
-        
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text()
-            
-            if text.strip():
-                word_doc.add_paragraph(text)
-                if page_num < len(doc) - 1:
-                    word_doc.add_page_break()
-        
-        doc.close()
-        
-        output_buffer = io.BytesIO()
-        word_doc.save(output_buffer)
-        output_buffer.seek(0)
-        
-        return StreamingResponse(output_buffer, media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document", headers={
-            "Content-Disposition": "attachment; filename=converted.docx"
-        })
-    
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error converting PDF to Word: {str(e)}")
+    async def body():
+        size = 0
+        async with aclosing(pages):
+            if first is None:
+                return
+            chunk = _text_page_chunk(first, params["format"])
+            size += len(chunk)
+            yield chunk
+            async for page in pages:
+                # Stop extracting for a client that has gone away. The response has started,
+                # so end the stream quietly; cache_result sees the disconnect too and
+                # keeps the partial body out of the result cache.
+                if await request.is_disconnected():
+                    log.debug("pdf-to-text: client disconnected at page %d", page["page"])
+                    return
+                chunk = _text_page_chunk(page, params["format"])
+                size += len(chunk)
+                yield chunk
+        record_bytes("pdf-to-text", "encode", size)
 
-@app.post("/pdf-to-excel")
-async def pdf_to_excel(request: Request):
-    try:
-        data = await request.json()
-        pdf_url = data.get("pdf_urls")
-        
-        if not pdf_url:
-            raise HTTPException(status_code=400, detail="Missing PDF URL.")
-        
-        if isinstance(pdf_url, list):
-            pdf_url = pdf_url[0]
-        
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF.")
-        
-        pdf_stream = io.BytesIO(response.content)
-        doc = fitz.open(stream=pdf_stream, filetype="pdf")
-        
-        from openpyxl import Workbook
-        
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "PDF Content"
-        
-        row_num = 1
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text()
-            
-            if text.strip():
-                lines = text.split('\n')
-                for line in lines:
-                    if line.strip():
-                        ws.cell(row=row_num, column=1, value=line.strip())
-                        row_num += 1
-                
-                ws.cell(row=row_num, column=1, value=f"--- Page {page_num + 1} ---")
-                row_num += 1
-        
-        doc.close()
-        
-        output_buffer = io.BytesIO()
-        wb.save(output_buffer)
-        output_buffer.seek(0)
-        
-        return StreamingResponse(output_buffer, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={
-            "Content-Disposition": "attachment; filename=converted.xlsx"
-        })
-    
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error converting PDF to Excel: {str(e)}")
+    output = TEXT_FORMATS[params["format"]]
+    return await cache_result(key, StreamingResponse(body(), media_type=output["mime"], headers={
+        "Content-Disposition": f"attachment; filename=converted.{output['ext']}"
+    }), request)
 
-@app.post("/pdf-to-powerpoint")
-async def pdf_to_powerpoint(request: Request):
-    try:
-        data = await request.json()
-        pdf_url = data.get("pdf_urls")
-        
-        if not pdf_url:
-            raise HTTPException(status_code=400, detail="Missing PDF URL.")
-        
-        if isinstance(pdf_url, list):
-            pdf_url = pdf_url[0]
-        
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF.")
-        
-        pdf_stream = io.BytesIO(response.content)
-        doc = fitz.open(stream=pdf_stream, filetype="pdf")
-        
-        from pptx import Presentation
-        from pptx.util import Inches
-        
-        prs = Presentation()
-        prs.slide_width = Inches(10)
-        prs.slide_height = Inches(7.5)
-        
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text()
-            
-            slide_layout = prs.slide_layouts[1]
-            slide = prs.slides.add_slide(slide_layout)
-            
-            title = slide.shapes.title
-            title.text = f"Page {page_num + 1}"
-            
-            content = slide.placeholders[1]
-            tf = content.text_frame
-            tf.text = text[:1000] if len(text) > 1000 else text
-            
-            if len(text) > 1000:
-                p = tf.add_paragraph()
-                p.text = "...(content truncated)"
-        
-        doc.close()
-        
-        output_buffer = io.BytesIO()
-        prs.save(output_buffer)
-        output_buffer.seek(0)
-        
-        return StreamingResponse(output_buffer, media_type="application/vnd.openxmlformats-officedocument.presentationml.presentation", headers={
-            "Content-Disposition": "attachment; filename=converted.pptx"
-        })
-    
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error converting PDF to PowerPoint: {str(e)}")
 
 @app.post("/pdf-to-text")
+@route_errors("Error converting PDF to text")
 async def pdf_to_text(request: Request):
-    try:
-        data = await request.json()
-        pdf_url = data.get("pdf_urls")
-        
-        if not pdf_url:
-            raise HTTPException(status_code=400, detail="Missing PDF URL.")
-        
-        if isinstance(pdf_url, list):
-            pdf_url = pdf_url[0]
-        
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF.")
-        
-        pdf_stream = io.BytesIO(response.content)
-        doc = fitz.open(stream=pdf_stream, filetype="pdf")
-        
-        text_content = ""
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text()
-            text_content += f"--- Page {page_num + 1} ---\n\n"
-            text_content += text + "\n\n"
-        
-        doc.close()
-        
-        text_buffer = io.BytesIO(text_content.encode('utf-8'))
-        text_buffer.seek(0)
-        
-        return StreamingResponse(text_buffer, media_type="text/plain", headers={
-            "Content-Disposition": "attachment; filename=converted.txt"
-        })
-    
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error converting PDF to text: {str(e)}")
+    data = await request.json()
+    pdf_url = data.get("pdf_urls")
+
+    if not pdf_url:
+        raise HTTPException(status_code=400, detail="Missing PDF URL.")
+
+    if isinstance(pdf_url, list):
+        pdf_url = pdf_url[0]
+
+    params = _text_params(data.get("format"), data.get("start"), data.get("end"))
+
+    response = await fetch(pdf_url, "pdf-to-text", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
+
+    return await _pdf_to_text(request, response.content, params)
+
+
+@uploads.post("/pdf-to-text/upload")
+@route_errors("Error converting PDF to text")
+async def pdf_to_text_upload(
+    request: Request,
+    file: UploadFile = File(...),
+    format: str = Form("text"),
+    start: str | None = Form(None),
+    end: str | None = Form(None),
+):
+    params = _text_params(format, start, end)
+    return await _pdf_to_text(request, upload_source(file), params)
+
+
+async def _pdf_to_ndjson(request: Request, pdf, tables: bool) -> Response:
+    key, cached = await cached_result(request, "pdf-to-ndjson", [pdf], {"tables": tables})
+    if cached is not None:
+        return cached
+
+    async def lines():
+        size = 0
+        async with aclosing(extract_pages("pdf-to-ndjson", pdf, tables=tables)) as pages:
+            async for page in pages:
+                line = (json.dumps(page, ensure_ascii=False) + "\n").encode("utf-8")
+                size += len(line)
+                yield line
+        record_bytes("pdf-to-ndjson", "encode", size)
+
+    return await cache_result(key, StreamingResponse(lines(), media_type="application/x-ndjson", headers={
+        "Content-Disposition": "attachment; filename=converted.ndjson"
+    }))
+
+
+@app.post("/pdf-to-ndjson")
+@route_errors("Error converting PDF to NDJSON")
+async def pdf_to_ndjson(request: Request):
+    data = await request.json()
+    pdf_url = data.get("pdf_urls")
+
+    if not pdf_url:
+        raise HTTPException(status_code=400, detail="Missing PDF URL.")
+
+    if isinstance(pdf_url, list):
+        pdf_url = pdf_url[0]
+
+    response = await fetch(pdf_url, "pdf-to-ndjson", "pdf")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to download PDF.")
+
+    return await _pdf_to_ndjson(request, response.content, bool(data.get("tables", False)))
+
+
+@uploads.post("/pdf-to-ndjson/upload")
+@route_errors("Error converting PDF to NDJSON")
+async def pdf_to_ndjson_upload(request: Request, file: UploadFile = File(...), tables: bool = Form(False)):
+    return await _pdf_to_ndjson(request, upload_source(file), tables)
 
 ###==================================================================###
 
+# Accept formats like: ["JPEG","PNG","WEBP","PDF","GIF","BMP","TIFF","ICO","PPM","EPS"]
+CONVERT_FORMATS = {
+    "JPEG": {"ext": "jpg", "mime": "image/jpeg"},
+    "JPG": {"ext": "jpg", "mime": "image/jpeg"},
+    "PNG": {"ext": "png", "mime": "image/png"},
+    "WEBP": {"ext": "webp", "mime": "image/webp"},
+    "PDF": {"ext": "pdf", "mime": "application/pdf"},
+    "GIF": {"ext": "gif", "mime": "image/gif"},
+    "BMP": {"ext": "bmp", "mime": "image/bmp"},
+    "TIFF": {"ext": "tiff", "mime": "image/tiff"},
+    "TIF": {"ext": "tiff", "mime": "image/tiff"},
+    "ICO": {"ext": "ico", "mime": "image/x-icon"},
+    "PPM": {"ext": "ppm", "mime": "image/x-portable-pixmap"},
+    "EPS": {"ext": "eps", "mime": "application/postscript"},
+}
+
+
+async def _download_images(endpoint: str, urls: list[str]) -> list[bytes | memoryview]:
+    responses = await fetch_all(urls, endpoint, "image")
+    for url, resp in zip(urls, responses):
+        if resp.status_code != 200:
+            raise HTTPException(status_code=400, detail=f"Failed to download image: {url}")
+    return [resp.content for resp in responses]
+
+
+def _convert_format(desired_ext: str | None) -> str:
+    desired = (desired_ext or "").strip().upper().lstrip(".")
+    if desired not in CONVERT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail="Unsupported format. Use one of: JPEG, PNG, WEBP, PDF, GIF, BMP, TIFF, ICO, PPM, EPS",
+        )
+    return desired
+
+
+async def _change_img_ext(request: Request, img_blobs: list, desired: str) -> Response:
+    target_format = "JPEG" if desired == "JPG" else desired
+    out_ext = CONVERT_FORMATS[desired]["ext"]
+    out_mime = CONVERT_FORMATS[desired]["mime"]
+
+    def _convert_one(file_bytes: bytes) -> bytes:
+        with Image.open(io.BytesIO(file_bytes)) as img:
+            if target_format == "JPEG" and img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, format=target_format)
+            return out.getvalue()
+
+    convert = timed("changeImgExt", "encode", _convert_one)
+
+    key, cached = await cached_result(request, "changeImgExt", img_blobs, {"format": target_format})
+    if cached is not None:
+        return cached
+
+    # Single URL -> return image directly
+    if len(img_blobs) == 1:
+        converted = await run_in_thread("changeImgExt", convert, img_blobs[0])
+        return await cache_result(key, StreamingResponse(
+            io.BytesIO(converted),
+            media_type=out_mime,
+            headers={"Content-Disposition": f"attachment; filename=converted.{out_ext}"},
+        ))
+
+    # Multiple URLs -> zip
+    async def entries():
+        idx = 0
+        async for converted in in_order("changeImgExt", convert, img_blobs):
+            idx += 1
+            yield f"image_{idx}.{out_ext}", converted
+
+    return await cache_result(key, await zip_streaming_response("changeImgExt", entries(), "converted_images.zip"))
+
+
 @app.post("/changeImgExt")
+@route_errors("Error converting image URLs")
 async def convert_image_urls(request: Request):
-    try:
-        data = await request.json()
-        img_urls = data.get("img_urls", [])
-        desired_ext = data.get("UserDesiredConvertedExtension")
-
-        if not img_urls or not isinstance(img_urls, list):
-            raise HTTPException(status_code=400, detail="img_urls must be a non-empty array.")
-
-        # Accept formats like: ["JPEG","PNG","WEBP","PDF","GIF","BMP","TIFF","ICO","PPM","EPS"]
-        desired = (desired_ext or "").strip().upper().lstrip(".")
-        allowed_formats = {
-            "JPEG": {"ext": "jpg", "mime": "image/jpeg"},
-            "JPG": {"ext": "jpg", "mime": "image/jpeg"},
-            "PNG": {"ext": "png", "mime": "image/png"},
-            "WEBP": {"ext": "webp", "mime": "image/webp"},
-            "PDF": {"ext": "pdf", "mime": "application/pdf"},
-            "GIF": {"ext": "gif", "mime": "image/gif"},
-            "BMP": {"ext": "bmp", "mime": "image/bmp"},
-            "TIFF": {"ext": "tiff", "mime": "image/tiff"},
-            "TIF": {"ext": "tiff", "mime": "image/tiff"},
-            "ICO": {"ext": "ico", "mime": "image/x-icon"},
-            "PPM": {"ext": "ppm", "mime": "image/x-portable-pixmap"},
-            "EPS": {"ext": "eps", "mime": "application/postscript"},
-        }
+    data = await request.json()
+    img_urls = data.get("img_urls", [])
+    desired_ext = data.get("UserDesiredConvertedExtension")
 
-        if desired not in allowed_formats:
-            raise HTTPException(
-                status_code=400,
-                detail="Unsupported format. Use one of: JPEG, PNG, WEBP, PDF, GIF, BMP, TIFF, ICO, PPM, EPS",
-            )
+    if not img_urls or not isinstance(img_urls, list):
+        raise HTTPException(status_code=400, detail="img_urls must be a non-empty array.")
 
-        target_format = "JPEG" if desired == "JPG" else desired
-        out_ext = allowed_formats[desired]["ext"]
-        out_mime = allowed_formats[desired]["mime"]
-
-        def _convert_one(file_bytes: bytes) -> bytes:
-            with Image.open(io.BytesIO(file_bytes)) as img:
-                if target_format == "JPEG" and img.mode in ("RGBA", "LA", "P"):
-                    img = img.convert("RGB")
-                out = io.BytesIO()
-                img.save(out, format=target_format)
-                return out.getvalue()
-
-        def _download(url: str) -> bytes:
-            resp = requests.get(url)
-            if resp.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Failed to download image: {url}")
-            return resp.content
-
-        # Single URL -> return image directly
-        if len(img_urls) == 1:
-            img_bytes = _download(img_urls[0])
-            converted = _convert_one(img_bytes)
-            return StreamingResponse(
-                io.BytesIO(converted),
-                media_type=out_mime,
-                headers={"Content-Disposition": f"attachment; filename=converted.{out_ext}"},
-            )
+    desired = _convert_format(desired_ext)
+    return await _change_img_ext(request, await _download_images("changeImgExt", img_urls), desired)
+
+
+@uploads.post("/changeImgExt/upload")
+@route_errors("Error converting images")
+async def convert_image_uploads(
+    request: Request,
+    files: list[UploadFile] = File(...),
+    UserDesiredConvertedExtension: str = Form(...),
+):
+    desired = _convert_format(UserDesiredConvertedExtension)
+    return await _change_img_ext(request, upload_sources(files), desired)
+
+
+def _compress_jpeg_to_target(file_bytes: bytes, target_bytes: int) -> tuple[bytes, int]:
+    """
+    Re-encodes an image as a JPEG of roughly target_bytes (aim within ±5%).
+    Quality is bisected (at most ~7 encodes per size) and, when no quality fits, the scale
+    factor is jumped to directly using JPEG size ~ pixel area, refitted from each result.
+    Returns (jpeg_bytes, number_of_encodes).
+    """
+    tolerance = 0.05  # aim within ±5%
+    lower = int(target_bytes * (1 - tolerance))
+    upper = int(target_bytes * (1 + tolerance))
+    encodes = 0
+
+    def encode_at(img_: Image.Image, q: int) -> bytes:
+        nonlocal encodes
+        encodes += 1
+        out = io.BytesIO()
+        # optimize off / no chroma subsampling: the largest encode for a given quality
+        img_.save(out, format="JPEG", quality=q, optimize=False, subsampling=0)
+        return out.getvalue()
 
-        # Multiple URLs -> zip
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-            for idx, url in enumerate(img_urls, start=1):
-                img_bytes = _download(url)
-                converted = _convert_one(img_bytes)
-                zf.writestr(f"image_{idx}.{out_ext}", converted)
-
-        zip_buffer.seek(0)
-        return StreamingResponse(
-            zip_buffer,
-            media_type="application/zip",
-            headers={"Content-Disposition": "attachment; filename=converted_images.zip"},
+    def in_band(b: bytes) -> bool:
+        return lower <= len(b) <= upper
+
+    # Helper: find closest by bisecting quality for a given image size. JPEG size grows
+    # with quality, so this also probes q=10 / q=95 when the target is out of reach.
+    def best_by_quality(img_: Image.Image, q_min: int = 10, q_max: int = 95) -> bytes:
+        best_bytes = None
+        best_diff = None
+        while q_min <= q_max:
+            q = (q_min + q_max) // 2
+            b = encode_at(img_, q)
+            d = abs(len(b) - target_bytes)
+            if best_diff is None or d < best_diff:
+                best_bytes, best_diff = b, d
+            if in_band(b):
+                return b
+            if len(b) > upper:
+                q_max = q - 1
+            else:
+                q_min = q + 1
+        return best_bytes  # type: ignore
+
+    def resized(img_: Image.Image, scale: float) -> Image.Image:
+        w, h = img_.size
+        return img_.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+
+    with Image.open(io.BytesIO(file_bytes)) as im:
+        # Normalize to RGB for JPEG
+        img = im.convert("RGB")
+
+    # First try at original size: bisect quality to get close
+    current_best = best_by_quality(img)
+    if in_band(current_best):
+        return current_best, encodes
+
+    w, h = img.size
+
+    # If we need to SHRINK, even q=10 is too big: pick the scale from the size model
+    if len(current_best) > upper:
+        min_scale = 50 / min(w, h) if min(w, h) > 50 else 1.0
+        scale = 1.0
+        for _ in range(6):
+            scale = max(min_scale, scale * (target_bytes / len(current_best)) ** 0.5)
+            current_best = best_by_quality(resized(img, scale))
+            if len(current_best) <= upper:
+                # in band, or best effort: closest under target
+                return current_best, encodes
+            if scale <= min_scale:
+                break
+            scale *= 0.97  # the model undershot; don't land on the same size again
+        raise HTTPException(
+            status_code=400,
+            detail="Cannot compress image to the requested sizeInKB.",
         )
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error converting image URLs: {str(e)}")
+    # If we need to ENLARGE, even q=95 is too small: upscale, again sized by the model
+    max_scale = 4.0
+    scale = 1.0
+    for _ in range(4):
+        if len(current_best) >= lower or scale >= max_scale:
+            break
+        scale = min(max_scale, scale * (target_bytes / len(current_best)) ** 0.5)
+        up = resized(img, scale)
+        # Use settings that generally increase JPEG size
+        current_best = encode_at(up, 95)
+        if in_band(current_best):
+            return current_best, encodes
+        if len(current_best) >= lower:
+            # now bracketed; refine with the quality search to get closer
+            return best_by_quality(up), encodes
+
+    # If still smaller than target even after upscaling, return best effort (largest we got)
+    return current_best, encodes
+
+
+def _target_bytes(size_kb) -> int:
+    if size_kb is None:
+        raise HTTPException(status_code=400, detail="sizeInKB is required.")
+
+    try:
+        target_kb = float(size_kb)
+    except Exception:
+        raise HTTPException(status_code=400, detail="sizeInKB must be a number.")
+
+    if target_kb <= 0:
+        raise HTTPException(status_code=400, detail="sizeInKB must be > 0.")
+
+    return int(target_kb * 1024)
+
+
+async def _resize_img_by_kb(request: Request, img_blobs: list, target_bytes: int) -> Response:
+    key, cached = await cached_result(request, "resizeImgByKB", img_blobs, {"target_bytes": target_bytes})
+    if cached is not None:
+        return cached
+
+    compress = timed("resizeImgByKB", "encode", functools.partial(_compress_jpeg_to_target, target_bytes=target_bytes))
+
+    # Single URL -> return image directly
+    if len(img_blobs) == 1:
+        converted, encodes = await run_in_thread("resizeImgByKB", compress, img_blobs[0])
+        ENCODE_ATTEMPTS.observe(encodes, "resizeImgByKB")
+        return await cache_result(key, StreamingResponse(
+            io.BytesIO(converted),
+            media_type="image/jpeg",
+            headers={
+                "Content-Disposition": "attachment; filename=compressed.jpg",
+                "X-Encode-Count": str(encodes),
+            },
+        ))
+
+    # Multiple URLs -> zip
+    async def entries():
+        idx = 0
+        async for converted, encodes in in_order("resizeImgByKB", compress, img_blobs):
+            idx += 1
+            ENCODE_ATTEMPTS.observe(encodes, "resizeImgByKB")
+            # headers are gone by the time each entry is ready, so the encode count
+            # travels in the entry's zip comment instead
+            yield f"image_{idx}.jpg", converted, f"encodes={encodes}".encode()
+
+    return await cache_result(key, await zip_streaming_response("resizeImgByKB", entries(), "compressed_images.zip"))
 
 
 @app.post("/resizeImgByKB")
+@route_errors("Error resizing images")
 async def resize_img_by_kb(request: Request):
     """
     Accepts JSON:
@@ -768,251 +3772,411 @@ async def resize_img_by_kb(request: Request):
       - If >1 urls: returns a zip of JPGs
       - Each output file will be <= sizeInKB (best-effort; will error if impossible)
     """
+    data = await request.json()
+    img_urls = data.get("img_urls", [])
+    size_kb = data.get("sizeInKB")
+
+    if not img_urls or not isinstance(img_urls, list):
+        raise HTTPException(status_code=400, detail="img_urls must be a non-empty array.")
+
+    target_bytes = _target_bytes(size_kb)
+    return await _resize_img_by_kb(request, await _download_images("resizeImgByKB", img_urls), target_bytes)
+
+
+@uploads.post("/resizeImgByKB/upload")
+@route_errors("Error resizing images")
+async def resize_img_by_kb_upload(request: Request, files: list[UploadFile] = File(...), sizeInKB: float = Form(...)):
+    """Same as /resizeImgByKB, with the images sent as multipart `files`."""
+    target_bytes = _target_bytes(sizeInKB)
+    return await _resize_img_by_kb(request, upload_sources(files), target_bytes)
+
+
+# Map PIL format -> (extension, mime)
+RESIZE_FORMATS = {
+    "JPEG": ("jpg", "image/jpeg"),
+    "JPG": ("jpg", "image/jpeg"),
+    "PNG": ("png", "image/png"),
+    "WEBP": ("webp", "image/webp"),
+    "GIF": ("gif", "image/gif"),
+    "BMP": ("bmp", "image/bmp"),
+    "TIFF": ("tiff", "image/tiff"),
+    "ICO": ("ico", "image/x-icon"),
+    "PPM": ("ppm", "image/x-portable-pixmap"),
+    "EPS": ("eps", "application/postscript"),
+    "PDF": ("pdf", "application/pdf"),
+}
+
+
+def _resize_dimensions(width, height) -> tuple[int, int]:
+    if width is None or height is None:
+        raise HTTPException(status_code=400, detail="width and height are required.")
+
     try:
-        data = await request.json()
-        img_urls = data.get("img_urls", [])
-        size_kb = data.get("sizeInKB")
+        w = int(width)
+        h = int(height)
+    except Exception:
+        raise HTTPException(status_code=400, detail="width and height must be numbers.")
 
-        if not img_urls or not isinstance(img_urls, list):
-            raise HTTPException(status_code=400, detail="img_urls must be a non-empty array.")
+    if w <= 0 or h <= 0:
+        raise HTTPException(status_code=400, detail="width and height must be > 0.")
 
-        if size_kb is None:
-            raise HTTPException(status_code=400, detail="sizeInKB is required.")
+    return w, h
+
+
+async def _resize_img_by_hw(request: Request, img_blobs: list, w: int, h: int) -> Response:
+    def _resize_keep_format(file_bytes: bytes) -> tuple[bytes, str, str]:
+        with Image.open(io.BytesIO(file_bytes)) as im:
+            pil_format = (im.format or "PNG").upper()
+            out_ext, out_mime = RESIZE_FORMATS.get(pil_format, ("png", "image/png"))
+
+            resized = im.resize((w, h), Image.LANCZOS)
+
+            # Handle modes when saving to formats that don't support alpha
+            save_format = pil_format if pil_format in RESIZE_FORMATS else "PNG"
+            if save_format in ("JPEG", "JPG") and resized.mode in ("RGBA", "LA", "P"):
+                resized = resized.convert("RGB")
 
-        try:
-            target_kb = float(size_kb)
-        except Exception:
-            raise HTTPException(status_code=400, detail="sizeInKB must be a number.")
-
-        if target_kb <= 0:
-            raise HTTPException(status_code=400, detail="sizeInKB must be > 0.")
-
-        target_bytes = int(target_kb * 1024)
-
-        def _download(url: str) -> bytes:
-            resp = requests.get(url)
-            if resp.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Failed to download image: {url}")
-            return resp.content
-
-        def _save_jpeg(
-            img: Image.Image,
-            quality: int,
-            *,
-            optimize: bool,
-            subsampling: int,
-        ) -> bytes:
             out = io.BytesIO()
-            img.save(
-                out,
-                format="JPEG",
-                quality=quality,
-                optimize=optimize,
-                subsampling=subsampling,
-            )
-            return out.getvalue()
+            resized.save(out, format=save_format)
+            return out.getvalue(), out_ext, out_mime
 
-        def _compress_to_target(file_bytes: bytes) -> bytes:
-            with Image.open(io.BytesIO(file_bytes)) as im:
-                # Normalize to RGB for JPEG
-                img = im.convert("RGB")
-                tolerance = 0.05  # aim within ±5%
-                lower = int(target_bytes * (1 - tolerance))
-                upper = int(target_bytes * (1 + tolerance))
-
-                def encode_at(img_: Image.Image, q: int) -> bytes:
-                    # For smaller outputs, optimize helps; for larger outputs, disable optimize.
-                    want_bigger = target_bytes > 0
-                    optimize = not want_bigger
-                    # subsampling=2 is smaller, subsampling=0 is larger/better quality
-                    subsampling = 2 if optimize else 0
-                    return _save_jpeg(img_, q, optimize=optimize, subsampling=subsampling)
-
-                # Helper: find closest by varying quality for a given image size
-                def best_by_quality(img_: Image.Image, q_min: int, q_max: int) -> bytes:
-                    best_bytes = None
-                    best_diff = None
-                    for q in range(q_max, q_min - 1, -1):
-                        b = _save_jpeg(
-                            img_,
-                            q,
-                            optimize=False if target_bytes >= lower else True,
-                            subsampling=0 if target_bytes >= lower else 2,
-                        )
-                        d = abs(len(b) - target_bytes)
-                        if best_diff is None or d < best_diff:
-                            best_bytes, best_diff = b, d
-                        if lower <= len(b) <= upper:
-                            return b
-                    return best_bytes  # type: ignore
-
-                # First try at original size: sweep quality to get close
-                current_best = best_by_quality(img, 10, 95)
-                if lower <= len(current_best) <= upper:
-                    return current_best
-
-                # If we need to SHRINK (target smaller than current best), downscale gradually
-                if len(current_best) > upper:
-                    w, h = img.size
-                    scale = 0.9
-                    while w > 50 and h > 50:
-                        nw, nh = max(1, int(w * scale)), max(1, int(h * scale))
-                        resized = img.resize((nw, nh), Image.LANCZOS)
-                        candidate = best_by_quality(resized, 10, 95)
-                        if lower <= len(candidate) <= upper:
-                            return candidate
-                        current_best = candidate
-                        if len(candidate) <= upper:
-                            # best effort: closest under target
-                            return candidate
-                        w, h = nw, nh
-                    raise HTTPException(
-                        status_code=400,
-                        detail="Cannot compress image to the requested sizeInKB.",
-                    )
+    resize = timed("resizeImgByHW", "encode", _resize_keep_format)
 
-                # If we need to ENLARGE (target larger than current best), upscale gradually
-                w, h = img.size
-                scale = 1.15
-                max_scale = 4.0
-                total_scale = 1.0
-                while total_scale < max_scale:
-                    if len(current_best) >= lower:
-                        break
-                    total_scale *= scale
-                    nw, nh = max(1, int(w * total_scale)), max(1, int(h * total_scale))
-                    up = img.resize((nw, nh), Image.LANCZOS)
-                    # Use settings that generally increase JPEG size
-                    candidate = _save_jpeg(up, 95, optimize=False, subsampling=0)
-                    current_best = candidate
-                    if lower <= len(candidate) <= upper:
-                        return candidate
-                    if len(candidate) >= lower:
-                        # now bracketed-ish; refine with quality sweep to get closer
-                        return best_by_quality(up, 10, 95)
-
-                # If still smaller than target even after upscaling, return best effort (largest we got)
-                return current_best
-
-        # Single URL -> return image directly
-        if len(img_urls) == 1:
-            img_bytes = _download(img_urls[0])
-            converted = _compress_to_target(img_bytes)
-            return StreamingResponse(
-                io.BytesIO(converted),
-                media_type="image/jpeg",
-                headers={"Content-Disposition": "attachment; filename=compressed.jpg"},
-            )
+    key, cached = await cached_result(request, "resizeImgByHW", img_blobs, {"width": w, "height": h})
+    if cached is not None:
+        return cached
 
-        # Multiple URLs -> zip
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-            for idx, url in enumerate(img_urls, start=1):
-                img_bytes = _download(url)
-                converted = _compress_to_target(img_bytes)
-                zf.writestr(f"image_{idx}.jpg", converted)
-
-        zip_buffer.seek(0)
-        return StreamingResponse(
-            zip_buffer,
-            media_type="application/zip",
-            headers={"Content-Disposition": "attachment; filename=compressed_images.zip"},
-        )
+    # Single URL -> return file directly
+    if len(img_blobs) == 1:
+        resized_bytes, out_ext, out_mime = await run_in_thread("resizeImgByHW", resize, img_blobs[0])
+        return await cache_result(key, StreamingResponse(
+            io.BytesIO(resized_bytes),
+            media_type=out_mime,
+            headers={"Content-Disposition": f"attachment; filename=resized.{out_ext}"},
+        ))
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error resizing images: {str(e)}")
+    # Multiple URLs -> zip
+    async def entries():
+        idx = 0
+        async for resized_bytes, out_ext, _ in in_order("resizeImgByHW", resize, img_blobs):
+            idx += 1
+            yield f"image_{idx}.{out_ext}", resized_bytes
+
+    return await cache_result(key, await zip_streaming_response("resizeImgByHW", entries(), "resized_images.zip"))
 
 
 @app.post("/resizeImgByHW")
+@route_errors("Error resizing images by height/width")
 async def resize_img_by_height_width(request: Request):
-    try:
-        data = await request.json()
-        img_urls = data.get("img_urls", [])
-        width = data.get("width")
-        height = data.get("height")
+    data = await request.json()
+    img_urls = data.get("img_urls", [])
+    width = data.get("width")
+    height = data.get("height")
 
-        if not img_urls or not isinstance(img_urls, list):
-            raise HTTPException(status_code=400, detail="img_urls must be a non-empty array.")
+    if not img_urls or not isinstance(img_urls, list):
+        raise HTTPException(status_code=400, detail="img_urls must be a non-empty array.")
 
-        if width is None or height is None:
-            raise HTTPException(status_code=400, detail="width and height are required.")
+    w, h = _resize_dimensions(width, height)
+    return await _resize_img_by_hw(request, await _download_images("resizeImgByHW", img_urls), w, h)
 
-        try:
-            w = int(width)
-            h = int(height)
-        except Exception:
-            raise HTTPException(status_code=400, detail="width and height must be numbers.")
-
-        if w <= 0 or h <= 0:
-            raise HTTPException(status_code=400, detail="width and height must be > 0.")
-
-        def _download(url: str) -> bytes:
-            resp = requests.get(url)
-            if resp.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Failed to download image: {url}")
-            return resp.content
-
-        # Map PIL format -> (extension, mime)
-        fmt_map = {
-            "JPEG": ("jpg", "image/jpeg"),
-            "JPG": ("jpg", "image/jpeg"),
-            "PNG": ("png", "image/png"),
-            "WEBP": ("webp", "image/webp"),
-            "GIF": ("gif", "image/gif"),
-            "BMP": ("bmp", "image/bmp"),
-            "TIFF": ("tiff", "image/tiff"),
-            "ICO": ("ico", "image/x-icon"),
-            "PPM": ("ppm", "image/x-portable-pixmap"),
-            "EPS": ("eps", "application/postscript"),
-            "PDF": ("pdf", "application/pdf"),
+
+@uploads.post("/resizeImgByHW/upload")
+@route_errors("Error resizing images by height/width")
+async def resize_img_by_height_width_upload(
+    request: Request,
+    files: list[UploadFile] = File(...),
+    width: int = Form(...),
+    height: int = Form(...),
+):
+    w, h = _resize_dimensions(width, height)
+    return await _resize_img_by_hw(request, upload_sources(files), w, h)
+
+
+###==================================================================###
+# Jobs: long-running tools can also be submitted as background jobs, so a slow compression or
+# conversion doesn't outlive the load balancer's request timeout. POST /jobs queues an
+# operation (any JSON route above) with the same body the route takes; the route handler
+# itself runs as the executor and its response is written to disk for GET /jobs/{id}/result.
+#   - JOB_WORKERS jobs run at once; the rest wait in a priority queue (high > normal > low)
+#   - once JOB_QUEUE_SIZE jobs are waiting, new submissions get 429
+#   - finished jobs and their results are dropped JOB_RETENTION seconds after they finish
+# Jobs live in this worker process only, so run a single worker (or sticky routing) for them.
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "3600"))
+JOB_RETRY_AFTER = int(os.getenv("JOB_RETRY_AFTER", "5"))
+
+JOB_PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+JOB_OPERATIONS = {
+    "merge-pdfs": merge_pdfs,
+    "unlock-pdf": unlock_pdf,
+    "split-pdf": split_pdf,
+    "dark-mode-pdf": convert_to_dark_mode,
+    "compress-pdf": compress_pdf,
+    "encrypt-pdf": encrypt_pdf,
+    "pdf-pipeline": pdf_pipeline,
+    "pdf-to-images": pdf_to_images,
+    "pdf-to-word": pdf_to_word,
+    "pdf-to-excel": pdf_to_excel,
+    "pdf-to-powerpoint": pdf_to_powerpoint,
+    "pdf-to-text": pdf_to_text,
+    "pdf-to-ndjson": pdf_to_ndjson,
+    "changeImgExt": convert_image_urls,
+    "resizeImgByKB": resize_img_by_kb,
+    "resizeImgByHW": resize_img_by_height_width,
+}
+
+
+class Job:
+    def __init__(self, operation: str, params: dict, priority: str):
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.params = params
+        self.priority = priority
+        self.status = "queued"  # queued -> running -> done | failed | cancelled
+        self.created = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.error: dict | None = None
+        self.result_path: str | None = None
+        self.result_headers: dict = {}
+        self.result_bytes = 0
+        self.task: asyncio.Task | None = None
+
+    def describe(self) -> dict:
+        info = {
+            "id": self.id,
+            "operation": self.operation,
+            "priority": self.priority,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
         }
+        if self.status == "done":
+            info["result"] = f"/jobs/{self.id}/result"
+            info["result_bytes"] = self.result_bytes
+            info["expires"] = self.finished + JOB_RETENTION
+        elif self.error is not None:
+            info["error"] = self.error
+        return info
 
-        def _resize_keep_format(file_bytes: bytes) -> tuple[bytes, str, str]:
-            with Image.open(io.BytesIO(file_bytes)) as im:
-                pil_format = (im.format or "PNG").upper()
-                out_ext, out_mime = fmt_map.get(pil_format, ("png", "image/png"))
-
-                resized = im.resize((w, h), Image.LANCZOS)
-
-                # Handle modes when saving to formats that don't support alpha
-                save_format = pil_format if pil_format in fmt_map else "PNG"
-                if save_format in ("JPEG", "JPG") and resized.mode in ("RGBA", "LA", "P"):
-                    resized = resized.convert("RGB")
-
-                out = io.BytesIO()
-                resized.save(out, format=save_format)
-                return out.getvalue(), out_ext, out_mime
-
-        # Single URL -> return file directly
-        if len(img_urls) == 1:
-            img_bytes = _download(img_urls[0])
-            resized_bytes, out_ext, out_mime = _resize_keep_format(img_bytes)
-            return StreamingResponse(
-                io.BytesIO(resized_bytes),
-                media_type=out_mime,
-                headers={"Content-Disposition": f"attachment; filename=resized.{out_ext}"},
-            )
 
-        # Multiple URLs -> zip
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-            for idx, url in enumerate(img_urls, start=1):
-                img_bytes = _download(url)
-                resized_bytes, out_ext, _ = _resize_keep_format(img_bytes)
-                zf.writestr(f"image_{idx}.{out_ext}", resized_bytes)
-
-        zip_buffer.seek(0)
-        return StreamingResponse(
-            zip_buffer,
-            media_type="application/zip",
-            headers={"Content-Disposition": "attachment; filename=resized_images.zip"},
-        )
+_jobs: dict[str, Job] = {}
+_job_queue: asyncio.PriorityQueue | None = None
+_job_workers: list[asyncio.Task] = []
+_job_dir: str | None = None
+_job_seq = 0  # keeps FIFO order within a priority
+
+
+def _job_request(job: Job) -> Request:
+    """A stand-in for the POST the route handler would normally receive."""
+    body = json.dumps(job.params).encode()
 
-    except HTTPException:
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": f"/{job.operation}",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "app": app,
+    }
+    return Request(scope, receive)
+
+
+async def _store_job_result(job: Job, response: Response) -> None:
+    global _job_dir
+    if _job_dir is None:
+        _job_dir = tempfile.mkdtemp(prefix="fileway-jobs-")
+    path = os.path.join(_job_dir, job.id)
+    size = 0
+    with open(path, "wb") as f:
+        if isinstance(response, StreamingResponse):
+            async for chunk in response.body_iterator:
+                size += len(chunk)
+                await run_in_thread(None, f.write, chunk)
+        else:
+            size = len(response.body)
+            await run_in_thread(None, f.write, response.body)
+    job.result_path = path
+    job.result_bytes = size
+    job.result_headers = {k: v for k, v in response.headers.items() if k not in ("content-length", "content-type")}
+    job.result_headers["content-type"] = response.headers.get("content-type", "application/octet-stream")
+
+
+async def _run_job(job: Job) -> None:
+    try:
+        response = await JOB_OPERATIONS[job.operation](_job_request(job))
+        if not isinstance(response, Response):
+            response = JSONResponse(response)
+        if response.status_code >= 400:
+            raise HTTPException(status_code=response.status_code, detail=bytes(response.body).decode(errors="replace"))
+        await _store_job_result(job, response)
+        job.status = "done"
+    except asyncio.CancelledError:
+        job.status = "cancelled"
         raise
+    except HTTPException as e:
+        job.status = "failed"
+        job.error = {"status_code": e.status_code, "detail": e.detail}
     except Exception as e:
         traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error resizing images by height/width: {str(e)}")
+        job.status = "failed"
+        job.error = {"status_code": 500, "detail": str(e)}
+    finally:
+        job.finished = time.time()
+        if job.status != "done":
+            _discard_job_result(job)
+
+
+async def _job_worker() -> None:
+    while True:
+        _, _, job = await _job_queue.get()
+        if job.status != "queued":  # cancelled while waiting
+            continue
+        job.status = "running"
+        job.started = time.time()
+        job.task = asyncio.ensure_future(_run_job(job))
+        try:
+            # wait() rather than await: cancelling the job must not stop this worker
+            await asyncio.wait({job.task})
+        finally:
+            job.task = None
+        _expire_jobs()
+
+
+def _get_job_queue() -> asyncio.PriorityQueue:
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = asyncio.PriorityQueue(maxsize=JOB_QUEUE_SIZE)
+        _job_workers.extend(asyncio.ensure_future(_job_worker()) for _ in range(JOB_WORKERS))
+    return _job_queue
+
+
+def _discard_job_result(job: Job) -> None:
+    if job.result_path is not None:
+        try:
+            os.remove(job.result_path)
+        except FileNotFoundError:
+            pass
+        job.result_path = None
+
+
+def _expire_jobs() -> None:
+    cutoff = time.time() - JOB_RETENTION
+    for job_id, job in list(_jobs.items()):
+        if job.finished is not None and job.finished < cutoff:
+            _discard_job_result(job)
+            del _jobs[job_id]
+
+
+def _get_job(job_id: str) -> Job:
+    _expire_jobs()
+    job = _jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job.")
+    return job
+
+
+async def _stop_jobs() -> None:
+    global _job_queue, _job_dir
+    running = [job.task for job in _jobs.values() if job.task is not None]
+    for task in _job_workers + running:
+        task.cancel()
+    await asyncio.gather(*_job_workers, *running, return_exceptions=True)
+    _job_workers.clear()
+    _jobs.clear()
+    _job_queue = None
+    if _job_dir is not None:
+        shutil.rmtree(_job_dir, ignore_errors=True)
+        _job_dir = None
+
+
+@app.post("/jobs")
+async def submit_job(request: Request):
+    """Queues {"operation", "params", "priority"}; returns 202 with the job to poll."""
+    global _job_seq
+    try:
+        data = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Body must be JSON.")
+
+    operation = data.get("operation")
+    params = data.get("params", {})
+    priority = data.get("priority", "normal")
+    if operation not in JOB_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"operation must be one of: {', '.join(JOB_OPERATIONS)}.")
+    if not isinstance(params, dict):
+        raise HTTPException(status_code=400, detail="params must be an object.")
+    if priority not in JOB_PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of: {', '.join(JOB_PRIORITIES)}.")
+
+    _expire_jobs()
+    job = Job(operation, params, priority)
+    _job_seq += 1
+    try:
+        _get_job_queue().put_nowait((JOB_PRIORITIES[priority], _job_seq, job))
+    except asyncio.QueueFull:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many queued jobs, try again later.",
+            headers={"Retry-After": str(JOB_RETRY_AFTER)},
+        )
+    _jobs[job.id] = job
+    return JSONResponse(job.describe(), status_code=202, headers={"Location": f"/jobs/{job.id}"})
+
+
+@app.get("/jobs")
+async def list_jobs():
+    """Queue depth and job counts by status (this worker)."""
+    _expire_jobs()
+    counts = collections.Counter(job.status for job in _jobs.values())
+    return {
+        "workers": JOB_WORKERS,
+        "queue_size": JOB_QUEUE_SIZE,
+        "queued": _job_queue.qsize() if _job_queue is not None else 0,
+        "jobs": dict(counts),
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return _get_job(job_id).describe()
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = _get_job(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=job.error["status_code"], detail=job.error["detail"])
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}.")
+    headers = dict(job.result_headers)
+    media_type = headers.pop("content-type")
+    return FileResponse(job.result_path, media_type=media_type, headers=headers)
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancels a queued or running job; for a finished one, drops it and its result early."""
+    job = _get_job(job_id)
+    if job.status == "queued":
+        job.status = "cancelled"
+        job.finished = time.time()
+    elif job.status == "running":
+        task = job.task
+        task.cancel()
+        await asyncio.wait({task})
+    else:
+        _discard_job_result(job)
+        del _jobs[job.id]
+    return {"id": job.id, "status": job.status if job.id in _jobs else "deleted"}
+
+
+# Last, so that it picks up every <path>/upload route declared above.
+app.include_router(uploads)